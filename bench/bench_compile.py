@@ -0,0 +1,181 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark of the whole compilation split into stages. Project is either given
+or generated with gen_project, each stage is timed separately and results are
+written as JSON, so runs on different revisions can be compared by scripts.
+
+Stages:
+    parse_project_file  - project file parsing
+    description         - description with annotation
+    translate_body      - content files translation
+    translate_notes     - notes file translation and notes body assembling
+    binaries            - reading and encoding of pictures, cache is not used
+    serialization       - writing of the generated xml
+    compile             - complete compile_project() run, cache is not used
+"""
+import json
+import optparse
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BASE_DIR)
+from lxml import etree
+from metafb2 import project
+from metafb2 import markup
+from metafb2 import images
+from metafb2 import cmd_compile
+from metafb2.xml import NSMAP
+import gen_project
+
+STAGES = ("parse_project_file", "description", "translate_body", "translate_notes", "binaries",
+          "serialization", "compile")
+
+class NullFile:
+    """
+    File-like object which counts and drops written data.
+    """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def run_stages(project_filename, out_filename):
+    """
+    Compile project once.
+
+    @return: tuple (times, counters), times is dict of stage wall times in seconds
+    """
+    times = dict()
+    counters = dict()
+
+    def timed(stage, func, *args):
+        started = time.time()
+        result = func(*args)
+        times[stage] = time.time() - started
+        return result
+
+    parsed = timed("parse_project_file", project.parse_project_file, project_filename)
+    project_props, authors, translators, doc_authors, doc_history, genres, book_sequences = parsed
+
+    ctx = markup.CompileContext()
+    desc, cover_image_name = timed("description", cmd_compile.build_description, ctx, project_props,
+                                   authors, translators, doc_authors, doc_history, genres, book_sequences)
+    body, book_images, notes_map = timed("translate_body", markup.translate_body, ctx,
+                                         project_props['content-file'])
+    parts = [desc, body]
+    if project_props['notes-file'] is not None:
+        notes_body, notes_images = timed("translate_notes", cmd_compile.build_notes_body, ctx,
+                                         project_props['notes-file'])
+        parts.append(notes_body)
+        book_images = book_images.union(notes_images)
+    if cover_image_name is not None:
+        book_images.add(cover_image_name)
+
+    def encode_binaries():
+        encoder = images.PictureEncoder()
+        size = 0
+        for img in book_images:
+            img_path = images.picture_path(img, project_props['images-path'])
+            for text in encoder.encode(img, img_path)[1]:
+                size += len(text)
+        return size
+    counters['binary_bytes'] = timed("binaries", encode_binaries)
+
+    def serialize():
+        out = NullFile()
+        with etree.xmlfile(out, encoding="utf-8") as xf:
+            with xf.element("FictionBook", nsmap=NSMAP):
+                for e in parts:
+                    xf.write(e, pretty_print=True)
+        return out.size
+    counters['xml_bytes'] = timed("serialization", serialize)
+
+    counters['sections'] = sum(1 for e in body.iter("section", markup.fb2_tag("section")))
+    counters['paragraphs'] = sum(1 for e in body.iter("p", markup.fb2_tag("p")))
+    counters['notes'] = len(notes_map)
+    counters['images'] = len(book_images)
+
+    timed("compile", cmd_compile.compile_project, project_filename, out_filename, images.PictureEncoder())
+    counters['book_bytes'] = os.path.getsize(out_filename)
+    counters['content_bytes'] = sum(os.path.getsize(fn) for fn in project_props['content-file'])
+
+    return times, counters
+
+def bench(project_filename, repeat):
+    """
+    Run all stages `repeat' times in the project directory.
+
+    @return: dict with results
+    """
+    project_filename = os.path.abspath(project_filename)
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(project_filename))
+    try:
+        runs = list()
+        for i in range(repeat):
+            times, counters = run_stages(project_filename, os.path.join(tmp_dir, "result.fb2"))
+            runs.append(times)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+    stages = dict()
+    for stage in STAGES:
+        values = [t[stage] for t in runs if stage in t]
+        if len(values) > 0:
+            stages[stage] = {'min': min(values), 'mean': sum(values) / len(values)}
+
+    return {'project': project_filename,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'lxml': etree.__version__,
+            'stages': stages,
+            'counters': counters,
+            }
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] [PROJECT_FILE]",
+                                   description="Benchmark compilation of PROJECT_FILE or of generated project "
+                                               "when PROJECT_FILE is not given.")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="compile project N times (default: %default)", metavar="N")
+    parser.add_option("-o", "--output", dest="out_filename",
+                      help="write results to FILE instead of stdout", metavar="FILE")
+    parser.add_option("--keep", dest="keep_dir",
+                      help="generate project into DIR and keep it", metavar="DIR")
+    group = optparse.OptionGroup(parser, "Generated project options")
+    gen_project.add_options(group)
+    parser.add_option_group(group)
+    (options, args) = parser.parse_args()
+
+    if len(args) > 1:
+        parser.error("there must be at most one PROJECT_FILE")
+
+    project_dir = None
+    if len(args) == 1:
+        result = bench(args[0], options.repeat)
+    else:
+        params = gen_project.generator_params(options)
+        project_dir = options.keep_dir or tempfile.mkdtemp()
+        try:
+            result = bench(gen_project.Generator(**params).generate(project_dir), options.repeat)
+        finally:
+            if options.keep_dir is None:
+                shutil.rmtree(project_dir)
+        result['project'] = {'generated': params}
+
+    out = sys.stdout
+    if options.out_filename is not None:
+        out = open(options.out_filename, "w")
+    json.dump(result, out, indent=2, sort_keys=True)
+    out.write("\n")
+    if out is not sys.stdout:
+        out.close()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python2.7
+"""
+Micro-benchmark of note references processing in markup.pprocess.
+
+Paragraph with N note references is processed repeatedly, time per reference
+must stay the same while N grows if references are processed in linear time.
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from metafb2 import markup
+
+def make_paragraph(refs_count):
+    return u" ".join([u"Some text with a reference{{note-%d}} in it." % i for i in range(refs_count)])
+
+def bench(refs_count, min_time=0.5):
+    text = make_paragraph(refs_count)
+    runs = 0
+    started = time.time()
+    while True:
+        markup.pprocess(markup.CompileContext(), "p", text)
+        runs += 1
+        elapsed = time.time() - started
+        if elapsed >= min_time:
+            break
+    return elapsed / runs
+
+if __name__ == "__main__":
+    print "%8s %14s %14s" % ("refs", "paragraph, ms", "per ref, us")
+    for refs_count in (10, 20, 40, 80, 160, 320, 640):
+        t = bench(refs_count)
+        print "%8d %14.3f %14.2f" % (refs_count, t * 1000, t / refs_count * 1000000)
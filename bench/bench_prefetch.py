@@ -0,0 +1,90 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark of pictures prefetching on slow storage. Generated project is compiled
+without cache with different numbers of prefetch threads, each read of a picture
+file is delayed to simulate network-mounted images directory.
+"""
+import optparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BASE_DIR)
+from metafb2 import images
+from metafb2 import cache
+from metafb2 import cmd_compile
+import gen_project
+
+class SlowFile:
+    """
+    File object which sleeps `latency' seconds before each read.
+    """
+    def __init__(self, f, latency):
+        self.__f = f
+        self.__latency = latency
+
+    def read(self, *args):
+        time.sleep(self.__latency)
+        return self.__f.read(*args)
+
+    def close(self):
+        self.__f.close()
+
+def slow_open(latency):
+    """
+    @return: open() replacement delaying reads of the picture files
+    """
+    def _open(filename, mode="r", *args):
+        f = open(filename, mode, *args)
+        if os.path.splitext(filename)[1].lower() in dict(images.CONTENT_TYPES):
+            return SlowFile(f, latency)
+        return f
+    return _open
+
+def bench(project_filename, threads, repeat):
+    """
+    @return: best wall time of the compilation in seconds
+    """
+    tmp_dir = tempfile.mkdtemp()
+    best = None
+    try:
+        for i in range(repeat):
+            started = time.time()
+            cmd_compile.compile_project(project_filename, os.path.join(tmp_dir, "result.fb2"),
+                                        images.PictureEncoder(prefetch_threads=threads))
+            elapsed = time.time() - started
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        shutil.rmtree(tmp_dir)
+    return best
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [OPTIONS]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="report best of N runs (default: %default)", metavar="N")
+    parser.add_option("--latency", dest="latency", type="float", default=0.005,
+                      help="delay each picture file read by SECONDS (default: %default)", metavar="SECONDS")
+    group = optparse.OptionGroup(parser, "Generated project options")
+    gen_project.add_options(group)
+    parser.add_option_group(group)
+    (options, args) = parser.parse_args()
+
+    # picture files are read by images and hashed by cache module
+    images.open = cache.open = slow_open(options.latency)
+    project_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        project_filename = gen_project.Generator(**gen_project.generator_params(options)).generate(project_dir)
+        os.chdir(project_dir)
+        print "%8s %12s" % ("threads", "compile, ms")
+        for threads in (0, 1, 2, 4, 8):
+            t = bench(project_filename, threads, options.repeat)
+            print "%8d %12.1f" % (threads, t * 1000)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(project_dir)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark of the body parser: sample/content.txt is repeated N times and
+translated with markup.translate_body.
+
+The parser is imported from the working tree, from the directory set with --source
+or from the git revision set with --rev, so the parser before a change can be
+timed on the same input, e.g. the if/elif chain of block probes replaced with
+the line classes dispatch:
+
+    bench_sections.py --rev 72c6a35^
+    bench_sections.py --rev 72c6a35
+"""
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def translate(markup, filename):
+    if hasattr(markup, "CompileContext"):
+        markup.translate_body(markup.CompileContext(), [filename])
+    else:
+        # parser before the compilation context was introduced
+        markup.translate_body(filename)
+
+def bench(markup, filename, repeat):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        translate(markup, filename)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def export_revision(rev, target_dir):
+    """
+    Extract metafb2 package of the git revision `rev' into `target_dir'
+    """
+    archive = subprocess.Popen(["git", "archive", rev, "metafb2"], cwd=BASE_DIR, stdout=subprocess.PIPE)
+    tar = tarfile.open(fileobj=archive.stdout, mode="r|")
+    tar.extractall(target_dir)
+    tar.close()
+    if archive.wait() != 0:
+        raise SystemExit("git archive of `%s' failed" % rev)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [OPTIONS]")
+    parser.add_option("-n", "--copies", dest="copies", type="int", default=200,
+                      help="repeat sample content N times (default: %default)", metavar="N")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="report best of N runs (default: %default)", metavar="N")
+    parser.add_option("--source", dest="source", default=BASE_DIR,
+                      help="import metafb2 package from DIR (default: working tree)", metavar="DIR")
+    parser.add_option("--rev", dest="rev",
+                      help="import metafb2 package of the git revision REV", metavar="REV")
+    (options, args) = parser.parse_args()
+
+    if options.rev is not None:
+        # run in a separate process, so the package of the working tree is never imported
+        source = tempfile.mkdtemp()
+        try:
+            export_revision(options.rev, source)
+            status = subprocess.call([sys.executable, os.path.abspath(__file__),
+                                      "-n", str(options.copies), "-r", str(options.repeat),
+                                      "--source", source])
+        finally:
+            shutil.rmtree(source)
+        sys.exit(status)
+
+    sys.path.insert(0, options.source)
+    from metafb2 import markup
+
+    content = open(os.path.join(BASE_DIR, "sample", "content.txt"), "rb").read()
+    if not content.endswith("\n"):
+        content += "\n"
+    fd, filename = tempfile.mkstemp(suffix=".txt")
+    try:
+        os.write(fd, content * options.copies)
+        os.close(fd)
+        lines_count = (content * options.copies).count("\n")
+        t = bench(markup, filename, options.repeat)
+    finally:
+        os.remove(filename)
+
+    print "%d lines: %.3f s, %.0f lines/s" % (lines_count, t, lines_count / t)
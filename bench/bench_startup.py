@@ -0,0 +1,110 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark of the command line script startup.
+
+Each command line is run in a new interpreter several times and the best wall
+time is reported. With --importtime modules imported by the command are listed
+with self and cumulative import times, like `python -X importtime' of newer
+interpreters does.
+"""
+import optparse
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCRIPT = os.path.join(BASE_DIR, "metafb2-bin")
+
+COMMAND_LINES = (["--help"],
+                 ["init", "--help"],
+                 ["compile", "--help"],
+                 ["compile-batch", "--help"],
+                 ["watch", "--help"],
+                 )
+
+def environ():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([BASE_DIR] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    return env
+
+def bench(args, repeat):
+    """
+    @return: best wall time of the script run with arguments `args' in seconds
+    """
+    devnull = open(os.devnull, "w")
+    best = None
+    try:
+        for i in range(repeat):
+            started = time.time()
+            subprocess.call([sys.executable, SCRIPT] + args, stdout=devnull, stderr=devnull, env=environ())
+            elapsed = time.time() - started
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        devnull.close()
+    return best
+
+def trace_imports(args):
+    """
+    Run the script with arguments `args' in the current interpreter and print import times
+    of all modules loaded by it to stderr.
+    """
+    import __builtin__
+    original_import = __builtin__.__import__
+    # stack of [name, started, children_time]
+    stack = list()
+    records = list()
+
+    def traced_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = len(sys.modules)
+        stack.append([name, time.time(), 0.0])
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            item = stack.pop()
+            cumulative = time.time() - item[1]
+            if stack:
+                stack[-1][2] += cumulative
+            if len(sys.modules) != loaded:
+                records.append((cumulative - item[2], cumulative, len(stack), name))
+
+    sys.argv = [SCRIPT] + args
+    __builtin__.__import__ = traced_import
+    try:
+        execfile(SCRIPT, {'__name__': "__main__", '__file__': SCRIPT})
+    except SystemExit:
+        pass
+    finally:
+        __builtin__.__import__ = original_import
+
+    print >>sys.stderr, "import time: self [us] | cumulative | imported package"
+    for self_time, cumulative, depth, name in records:
+        print >>sys.stderr, "import time: %9d | %10d | %s%s" % (self_time * 1000000, cumulative * 1000000,
+                                                                "  " * depth, name)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] [-- SCRIPT_ARGS...]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=10,
+                      help="report best of N runs (default: %default)", metavar="N")
+    parser.add_option("--importtime", dest="importtime", action="store_true", default=False,
+                      help="print import times of the script run with SCRIPT_ARGS")
+    parser.add_option("--trace", dest="trace", action="store_true", default=False,
+                      help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.trace:
+        # run inside the new interpreter started below
+        sys.stdout = open(os.devnull, "w")
+        trace_imports(args)
+    elif options.importtime:
+        subprocess.call([sys.executable, os.path.abspath(__file__), "--trace", "--"] + args, env=environ())
+    else:
+        if len(args) > 0:
+            command_lines = [args]
+        else:
+            command_lines = COMMAND_LINES
+        for command_line in command_lines:
+            t = bench(command_line, options.repeat)
+            print "%-30s %8.1f ms" % (" ".join(command_line), t * 1000)
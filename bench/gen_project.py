@@ -0,0 +1,229 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic metafb2 projects for benchmarks.
+
+Project consists of the content file with nested sections, paragraphs with inline
+markup and note references, poems, cites and pictures, notes file with all
+referenced notes, annotation and the pictures directory.
+"""
+import optparse
+import os
+import os.path
+import random
+import struct
+import zlib
+
+WORDS = (u"lorem", u"ipsum", u"dolor", u"sit", u"amet", u"consectetur", u"adipiscing", u"elit",
+         u"sed", u"do", u"eiusmod", u"tempor", u"incididunt", u"labore", u"magna", u"aliqua",
+         u"книга", u"глава", u"слово", u"текст", u"строка", u"абзац", u"примечание", u"стих")
+
+PROJECT_TEMPLATE = u"""[Project]
+content-file = content.txt
+images-path = images
+notes-file = notes.txt
+annotation-file = annotation.txt
+book-title = Synthetic book
+genres = sf
+lang = en
+program-used = metafb2
+book-id = synthetic-%(seed)d
+book-version = 1.0
+date = 2000-01-01
+doc-date = 2000-01-01
+%(cover)s
+[Author/1]
+first-name = Synthetic
+last-name = Author
+
+[DocAuthor/1]
+nickname = generator
+"""
+
+def add_options(parser):
+    """
+    Add generator options to `parser'.
+    """
+    parser.add_option("--sections", dest="sections", type="int", default=30,
+                      help="number of top level sections (default: %default)", metavar="N")
+    parser.add_option("--depth", dest="depth", type="int", default=2,
+                      help="sections nesting depth (default: %default)", metavar="N")
+    parser.add_option("--subsections", dest="subsections", type="int", default=3,
+                      help="number of subsections of each nested section (default: %default)", metavar="N")
+    parser.add_option("--paragraphs", dest="paragraphs", type="int", default=20,
+                      help="number of paragraphs in each innermost section (default: %default)", metavar="N")
+    parser.add_option("--paragraph-words", dest="paragraph_words", type="int", default=80,
+                      help="average paragraph length in words (default: %default)", metavar="N")
+    parser.add_option("--note-density", dest="note_density", type="float", default=0.2,
+                      help="average number of note references per paragraph (default: %default)", metavar="X")
+    parser.add_option("--unreferenced-notes", dest="unreferenced_notes", type="int", default=0,
+                      help="number of notes which are never referenced (default: %default)", metavar="N")
+    parser.add_option("--poems", dest="poems", type="int", default=1,
+                      help="number of poems in each innermost section (default: %default)", metavar="N")
+    parser.add_option("--cites", dest="cites", type="int", default=1,
+                      help="number of cites in each innermost section (default: %default)", metavar="N")
+    parser.add_option("--images", dest="images", type="int", default=10,
+                      help="number of pictures (default: %default)", metavar="N")
+    parser.add_option("--image-size", dest="image_size", type="int", default=100,
+                      help="size of each picture in kilobytes (default: %default)", metavar="N")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="random generator seed (default: %default)", metavar="N")
+
+def generator_params(options):
+    """
+    @return: dict of generator parameters taken from parsed options
+    """
+    keys = ("sections", "depth", "subsections", "paragraphs", "paragraph_words", "note_density",
+            "unreferenced_notes", "poems", "cites", "images", "image_size", "seed")
+    return dict((k, getattr(options, k)) for k in keys)
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+def write_png(filename, size):
+    """
+    Write RGB picture filled with noise, noise is not compressible so file size is close to `size'.
+    """
+    width = max(1, int((size / 3) ** 0.5))
+    height = max(1, size / 3 / width)
+    raw = "".join("\0" + os.urandom(width * 3) for y in range(height))
+    f = open(filename, "wb")
+    try:
+        f.write("\x89PNG\r\n\x1a\n")
+        f.write(png_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(png_chunk("IDAT", zlib.compress(raw, 1)))
+        f.write(png_chunk("IEND", ""))
+    finally:
+        f.close()
+
+class Generator:
+
+    def __init__(self, sections=30, depth=2, subsections=3, paragraphs=20, paragraph_words=80,
+                 note_density=0.2, unreferenced_notes=0, poems=1, cites=1, images=10, image_size=100,
+                 seed=1):
+        self.sections = sections
+        self.depth = depth
+        self.subsections = subsections
+        self.paragraphs = paragraphs
+        self.paragraph_words = paragraph_words
+        self.note_density = note_density
+        self.unreferenced_notes = unreferenced_notes
+        self.poems = poems
+        self.cites = cites
+        self.images = images
+        self.image_size = image_size
+        self.seed = seed
+        self.__rnd = random.Random(seed)
+        self.__notes_count = 0
+        self.__next_image = 0
+
+    def words(self, count):
+        return u" ".join(self.__rnd.choice(WORDS) for i in range(max(1, count)))
+
+    def paragraph(self, refs=True):
+        rnd = self.__rnd
+        words_count = rnd.randint(self.paragraph_words / 2 + 1, self.paragraph_words * 3 / 2 + 1)
+        words = [rnd.choice(WORDS) for i in range(words_count)]
+        if rnd.random() < 0.3:
+            i = rnd.randrange(len(words))
+            words[i] = u"**%s**" % words[i]
+        if rnd.random() < 0.3:
+            i = rnd.randrange(len(words))
+            words[i] = u"//%s//" % words[i]
+
+        refs_count = 0
+        if refs:
+            refs_count = int(self.note_density)
+            if rnd.random() < self.note_density - refs_count:
+                refs_count += 1
+        for r in range(refs_count):
+            self.__notes_count += 1
+            i = rnd.randrange(len(words))
+            words[i] = u"%s{{note-%d}}" % (words[i], self.__notes_count)
+
+        # break paragraph into lines like a hand-written text
+        lines = [u" ".join(words[i:i+12]) for i in range(0, len(words), 12)]
+        return u"\n".join(lines) + u"\n\n"
+
+    def poem(self):
+        stanzas = [u"\n".join(self.words(5) for i in range(4)) for j in range(3)]
+        return u"@poem\n%s\n@poem/%s\n\n" % (u"\n\n".join(stanzas), self.words(2))
+
+    def cite(self):
+        return u"@cite\n%s%s@cite/%s\n\n" % (self.paragraph(), self.paragraph(), self.words(2))
+
+    def image(self):
+        if self.images == 0:
+            return u""
+        name = u"img-%d.png" % (self.__next_image % self.images)
+        self.__next_image += 1
+        return u"@img:%s\n\n" % name
+
+    def section(self, out, level, path):
+        out.append(u"%s %s\n" % (u"=" * level, self.words(3)))
+        out.append(u"@id:section-%s\n\n" % u"-".join(str(i) for i in path))
+        if level < self.depth:
+            for i in range(self.subsections):
+                self.section(out, level + 1, path + [i])
+            return
+
+        for i in range(self.paragraphs):
+            out.append(self.paragraph())
+            if i == self.paragraphs / 3:
+                out.append(self.image())
+            for n in range(self.poems):
+                if i == self.paragraphs * (n + 1) / (self.poems + 1):
+                    out.append(self.poem())
+            for n in range(self.cites):
+                if i == self.paragraphs * (n + 1) / (self.cites + 1):
+                    out.append(self.cite())
+
+    def write_file(self, filename, parts):
+        f = open(filename, "wb")
+        try:
+            f.write(u"".join(parts).encode("utf-8"))
+        finally:
+            f.close()
+
+    def generate(self, target_dir):
+        """
+        Generate project in the directory `target_dir'.
+
+        @return: path to the project file
+        """
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        content = list()
+        for i in range(self.sections):
+            self.section(content, 1, [i])
+        self.write_file(os.path.join(target_dir, "content.txt"), content)
+
+        notes = list()
+        for i in range(1, self.__notes_count + self.unreferenced_notes + 1):
+            notes.append(u"= * * *\n@id:note-%d\n\n%s" % (i, self.paragraph(False)))
+        self.write_file(os.path.join(target_dir, "notes.txt"), notes)
+
+        self.write_file(os.path.join(target_dir, "annotation.txt"), [self.paragraph(False), self.paragraph(False)])
+
+        images_dir = os.path.join(target_dir, "images")
+        if not os.path.isdir(images_dir):
+            os.makedirs(images_dir)
+        for i in range(self.images):
+            write_png(os.path.join(images_dir, "img-%d.png" % i), self.image_size * 1024)
+
+        cover = u""
+        if self.images > 0:
+            cover = u"cover-image = img-0.png\n"
+        project_filename = os.path.join(target_dir, "project.mfb2")
+        self.write_file(project_filename, [PROJECT_TEMPLATE % {'seed': self.seed, 'cover': cover}])
+        return project_filename
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] <TARGET_DIR>")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("there must be just one TARGET_DIR")
+
+    print Generator(**generator_params(options)).generate(args[0])
@@ -0,0 +1,235 @@
+"""
+Persistent on-disk cache
+"""
+import os
+import os.path
+import tempfile
+import hashlib
+
+DEFAULT_CACHE_SIZE = 512 # megabytes
+
+def default_cache_dir():
+    """
+    @return: path to the user cache directory
+    """
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "metafb2")
+
+def make_key(*components):
+    """
+    @return: cache key built from the list of values
+    """
+    h = hashlib.sha1()
+    for c in components:
+        if isinstance(c, unicode):
+            c = c.encode("utf-8")
+        elif not isinstance(c, str):
+            c = repr(c)
+        h.update(c)
+        h.update("\0")
+    return h.hexdigest()
+
+def file_digest(filename, chunk_size=1024*1024):
+    """
+    @return: hex digest of the file content
+    """
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+class EntryWriter:
+    """
+    File-like object for creating cache entry, entry becomes visible after commit().
+    """
+    def __init__(self, cache, key, f, tmp_filename):
+        self.__cache = cache
+        self.__key = key
+        self.__f = f
+        self.__tmp_filename = tmp_filename
+
+    def write(self, data):
+        self.__f.write(data)
+
+    def commit(self):
+        self.__f.close()
+        self.__cache._store(self.__key, self.__tmp_filename)
+
+    def abort(self):
+        self.__f.close()
+        if os.path.exists(self.__tmp_filename):
+            os.remove(self.__tmp_filename)
+
+class DiskCache:
+    """
+    Size-bounded key/value storage. Each entry is stored in a separate file, file modification
+    time is updated on every hit and used as the last access time for LRU eviction. Entries are
+    created through temporary files and renamed in place, so concurrent processes never see
+    partially written entries.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        """
+        @param max_size: cache size limit in megabytes
+        """
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def open(self, key):
+        """
+        @return: file object opened for reading or None if there is no such entry
+        """
+        filename = self.__entry_path(key)
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return f
+
+    def touch(self, key):
+        """
+        Mark entry `key' as recently used without reading it.
+        """
+        try:
+            os.utime(self.__entry_path(key), None)
+        except OSError:
+            pass
+
+    def get(self, key):
+        """
+        @return: entry value or None if there is no such entry
+        """
+        f = self.open(key)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def writer(self, key):
+        """
+        @return: EntryWriter object for the new entry
+        """
+        fd, tmp_filename = tempfile.mkstemp(prefix="tmp-", dir=self.path)
+        return EntryWriter(self, key, os.fdopen(fd, "wb"), tmp_filename)
+
+    def put(self, key, value):
+        w = self.writer(key)
+        try:
+            w.write(value)
+        except:
+            w.abort()
+            raise
+        w.commit()
+
+    def _store(self, key, tmp_filename):
+        filename = self.__entry_path(key)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # directory is created by another process
+                pass
+        os.rename(tmp_filename, filename)
+
+    def evict(self):
+        """
+        Remove least recently used entries until total cache size fits the limit.
+        """
+        entries = list()
+        total_size = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if dirpath == self.path:
+                # skip temporary files
+                continue
+            for fn in filenames:
+                filename = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+                total_size += st.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        entries.sort()
+        for mtime, size, filename in entries:
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+class MemoryCache:
+    """
+    In-memory key/value storage for long-running processes. Entries which are not accessed
+    between two sweep() calls are dropped. When `backend' cache is set, missing entries are
+    looked up in it and new entries are stored in it too.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.__entries = dict()
+        self.__used = set()
+
+    def get(self, key):
+        """
+        @return: entry value or None if there is no such entry
+        """
+        value = self.__entries.get(key)
+        if value is None and self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.__entries[key] = value
+        if value is not None:
+            self.__used.add(key)
+        return value
+
+    def touch(self, key):
+        """
+        Mark entry `key' as used, so it survives the next sweep(), without reading it.
+        """
+        if key in self.__entries:
+            self.__used.add(key)
+        elif self.backend is not None:
+            self.backend.touch(key)
+
+    def put(self, key, value):
+        self.__entries[key] = value
+        self.__used.add(key)
+        if self.backend is not None:
+            self.backend.put(key, value)
+
+    def sweep(self):
+        """
+        Drop entries which are not accessed since the previous call.
+        """
+        for key in self.__entries.keys():
+            if key not in self.__used:
+                del self.__entries[key]
+        self.__used = set()
@@ -2,13 +2,17 @@
 """
 
 import optparse
-import codecs
 import os.path
+import sys
 from lxml import etree
-from base64 import b64encode as base64_encode
 from .print_ext import print_err
 from . import project
 from . import markup
+from . import images
+from . import cache
+from .stats import CompileStats
+from .stats import stage
+from .zipstream import ZipEntryWriter
 from .xml import NSMAP
 from .xml import XLINK_NAMESPACE
 from .xml import append_element
@@ -21,7 +25,104 @@ class OptionParser(optparse.OptionParser):
     def __init__(self):
         optparse.OptionParser.__init__(self, usage="%prog compile [OPTIONS] <PROJECT_FILE>")
         self.add_option("-o", "--output", dest="out_filename", 
-                        help="write generated FictionBook XML to FILE", metavar="FILE")
+                        help="write generated FictionBook XML to FILE, FILE with `.zip' extension "
+                             "is written as zip archive", metavar="FILE")
+        self.add_option("--check", dest="check", action="store_true", default=False,
+                        help="only check markup, pictures and references and report all errors, "
+                             "the book is not written")
+        self.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                        help="process sections on N worker processes (default: %default)", metavar="N")
+        self.add_option("--profile", dest="profile", action="store_true", default=False,
+                        help="print time spent in compilation stages and counters, counters don't "
+                             "include sections translated on worker processes or taken from cache")
+        self.add_option("--profile-output", dest="profile_output",
+                        help="write compilation stages statistics (and memory usage with --mem-report) "
+                             "as JSON to FILE", metavar="FILE")
+        self.add_option("--mem-report", dest="mem_report", action="store_true", default=False,
+                        help="print process peak RSS (getrusage), its growth during each compilation "
+                             "stage and current RSS at the stage end (Linux only), Python allocations "
+                             "are not traced")
+        self.add_option("--cprofile", dest="cprofile",
+                        help="profile compilation with cProfile and dump pstats data to FILE", metavar="FILE")
+        add_zip_options(self)
+        add_image_options(self)
+        add_cache_options(self)
+
+def add_image_options(parser):
+    """
+    Add options controlling pictures optimization to `parser'.
+    """
+    parser.add_option("--optimize-images", dest="optimize_images", action="store_true", default=False,
+                      help="recompress PNG pictures losslessly and re-encode JPEG pictures before "
+                           "embedding, requires Pillow")
+    parser.add_option("--max-image-size", dest="max_image_size", type="int",
+                      help="downscale JPEG pictures larger than PX pixels, implies --optimize-images",
+                      metavar="PX")
+    parser.add_option("--jpeg-quality", dest="jpeg_quality", type="int", default=85,
+                      help="quality of re-encoded JPEG pictures (default: %default)", metavar="Q")
+    parser.add_option("--image-jobs", dest="image_jobs", type="int",
+                      help="optimize pictures on N worker processes (default: number of CPUs)", metavar="N")
+    parser.add_option("--prefetch-threads", dest="prefetch_threads", type="int", default=images.PREFETCH_THREADS,
+                      help="read and encode pictures on N background threads while the text is translated, "
+                           "0 disables prefetching (default: %default)", metavar="N")
+
+def make_optimizer(options):
+    """
+    @return: PictureOptimizer configured by the command line options or None if pictures 
+             are not optimized
+    """
+    if not options.optimize_images and options.max_image_size is None:
+        return None
+    if images.Image is None:
+        print_err("pictures optimization requires Pillow")
+        exit(1)
+    return images.PictureOptimizer(options.max_image_size, options.jpeg_quality, options.image_jobs)
+
+def add_zip_options(parser):
+    """
+    Add options controlling compression of the generated book to `parser'.
+    """
+    parser.add_option("--zip", dest="zip", action="store_true", default=False,
+                      help="write generated book into zip archive, `.zip' is appended to the output "
+                           "file name if it's missing")
+    parser.add_option("--zip-level", dest="zip_level", type="int", default=6,
+                      help="zip compression level from 0 (no compression) to 9 (best compression) "
+                           "(default: %default)", metavar="N")
+
+def zip_output(out_filename, use_zip):
+    """
+    @return: tuple (out_filename, zipped), output file name with `.zip' extension if book must be zipped
+    """
+    if out_filename.endswith(".zip"):
+        return out_filename, True
+    if use_zip:
+        return out_filename + ".zip", True
+    return out_filename, False
+
+def zip_entry_name(out_filename):
+    """
+    @return: name of the book in zip archive `out_filename'
+    """
+    name = os.path.basename(out_filename)
+    if name.endswith(".zip"):
+        name = name[:-len(".zip")]
+    if not name.endswith(".fb2"):
+        name += ".fb2"
+    return name
+
+def add_cache_options(parser):
+    """
+    Add options controlling the cache of encoded pictures and translated sections to `parser'.
+    """
+    parser.add_option("-i", "--incremental", dest="incremental", action="store_true", default=False,
+                      help="reuse translated files and sections which are not changed since previous compilation")
+    parser.add_option("--no-cache", dest="use_cache", action="store_false", default=True,
+                      help="do not use cache of encoded pictures and translated sections")
+    parser.add_option("--cache-dir", dest="cache_dir", default=cache.default_cache_dir(),
+                      help="store cache in DIR (default: %default)", metavar="DIR")
+    parser.add_option("--cache-size", dest="cache_size", type="int", 
+                      default=cache.DEFAULT_CACHE_SIZE,
+                      help="limit cache size to SIZE megabytes (default: %default)", metavar="SIZE")
 
 def format_author(a):
     if "nickname" in a and a['nickname'] is not None:
@@ -34,21 +135,14 @@ def format_author(a):
             
     return " ".join(components)
 
-def action(cmd_args):
-    parser = OptionParser()
-    (options, args) = parser.parse_args(args=cmd_args)
-    
-    if options.out_filename is None:
-        options.out_filename = "result.fb2"
-
-    if len(args) > 1:
-        print_err("there must just one PROJECT_FILE")
-        exit(1)
-     
-    project_props, authors, translators, doc_authors, doc_history, genres, book_sequences = project.parse_project_file(args[0])
+def build_description(ctx, project_props, authors, translators, doc_authors, doc_history, genres, book_sequences,
+                      cache=None):
+    """
+    Build <description> element of the book, translated annotation is taken from `cache' when it's set.
     
-    root = etree.Element("FictionBook", nsmap=NSMAP)
-    desc = append_element(root, "description")
+    @return: tuple (description, cover_image_name)
+    """
+    desc = markup.fbe("description")
     title_info = append_element(desc, "title-info")
     for g in genres:
         append_element(title_info, "genre", g)
@@ -58,7 +152,7 @@ def action(cmd_args):
         
     append_element(title_info, "book-title", project_props['book-title'])
     if project_props['annotation-file'] is not None:
-        ann = markup.translate_annotation(project_props['annotation-file'])
+        ann = markup.translate_annotation(ctx, project_props['annotation-file'], cache)
         if len(list(ann)) != 0:
             title_info.append(ann)
         
@@ -68,8 +162,7 @@ def action(cmd_args):
         cover_image_name = project_props['cover-image']
         cover = append_element(title_info, "coverpage")
         coverimage = append_element(cover, "image")
-        coverimage.set("{%s}href" % XLINK_NAMESPACE, "#%s" % base64_encode(cover_image_name))
-        # set value later
+        coverimage.set("{%s}href" % XLINK_NAMESPACE, "#%s" % make_id(cover_image_name))
         
     append_element_cond(title_info, "lang", project_props['lang'])
     append_element_cond(title_info, "src-lang", project_props['src-lang'])
@@ -106,94 +199,340 @@ def action(cmd_args):
     append_element_cond(publ_info, "year", project_props['publish-year'])
     append_element_cond(publ_info, "isbn", project_props['publish-isbn'])
     
-    #body = append_element(root, "body")
-    #append_element(body, "section")
+    return desc, cover_image_name
+
+def build_notes_body(ctx, notes_file, cache=None):
+    """
+    Translate notes referenced from the text and build <body name="notes"> element
+    with them, in order of their numbers.
+    
+    @return: tuple (notes_body, notes_images)
+    """
+    if not os.path.isfile(notes_file):
+        raise markup.InvalidMarkupError("Notes files not found")
+    notes_images, notes_sections = markup.translate_notes(ctx, notes_file, cache)
+    # notes_sections - dict, key is note_id, only referenced notes are translated
     
-    body, images, notes_map = markup.translate_body(project_props['content-file'])
-    root.append(body)
+    # notes_map.keys() - list of all notes in the text
+    notes_map = ctx.notes_map
+    for note_id in notes_map.keys():
+        if note_id not in notes_sections:
+            raise markup.InvalidMarkupError("Note id `%s' declared but not defined" % note_id)
     
-    # prepare book title
-    title = markup.fbe("title")
-    # append authors list
-    authors_list = [format_author(a) for a in authors]
-    title.append(markup.pprocess("p", ", ".join(authors_list)))
-
-    # append book title
-    title.append(markup.pprocess("p", project_props['book-title']))
-    body.insert(0, title)
+    # form list of notes that should be included into result file
+    rev_notes_map = dict()
+    for k,v in notes_map.iteritems():
+        if v in rev_notes_map:
+            raise markup.InvalidMarkupError("Each note MUST occur just once!")
+        
+        rev_notes_map[v] = k
     
-    body.insert(0, title)
+    notes_body = markup.fbe("body")
+    notes_body.set("name", "notes")
 
-    # process notes
-    if project_props['notes-file'] is not None:
-        notes_file = project_props['notes-file']
-        if not os.path.isfile(notes_file):
-            raise markup.InvalidMarkupError("Notes files not found")
-        #notes_body, notes_images = markup.translate_body(notes_file)
-        notes_images, notes_sections = markup.translate_notes(notes_file)
-        # notes_sections - dict, key is note_id
-        
-        all_note_ids = notes_sections.keys()
-        # notes_map.keys() - list of all notes in the text
-        # all_notes - list of all notes id
-        for note_id in notes_map.keys():
-            if note_id not in all_note_ids:
-                raise markup.InvalidMarkupError("Note id `%s' declared but not defined" % note_id)
+    for k in sorted(rev_notes_map.keys()):
+        note_id = rev_notes_map[k]
+        notes_sections[note_id].sx_title.clear()
+        notes_sections[note_id].sx_title.append(markup.fbe("p", str(k)))
+        notes_body.append(notes_sections[note_id].sx)
         
+    return notes_body, notes_images
 
-        # form list of notes that should be included into result file
-        rev_notes_map = dict()
-        for k,v in notes_map.iteritems():
-            if v in rev_notes_map:
-                raise markup.InvalidMarkupError("Each note MUST occur just once!")
-            
-            rev_notes_map[v] = k
-        
-        notes_body = markup.fbe("body")
-        notes_body.set("name", "notes")
-        root.append(notes_body)
-
-        for k in sorted(rev_notes_map.keys()):
-            note_id = rev_notes_map[k]
-            notes_sections[note_id].sx_title.clear()
-            notes_sections[note_id].sx_title.append(markup.fbe("p", str(k)))
-            notes_body.append(notes_sections[note_id].sx)
+def write_binary(xf, img, images_path, encoder, stats=None):
+    """
+    Write <binary> element with encoded picture file `img' into the xmlfile context `xf',
+    picture is read and encoded chunk by chunk.
+    """
+    img_path = images.picture_path(img, images_path)
+    content_type, chunks = encoder.encode(img, img_path)
+    attrs = {'id': make_id(img), 'content-type': content_type}
+    
+    with xf.element("binary", attrs):
+        for text in chunks:
+            if stats is not None:
+                stats.count("binary_bytes", len(text))
+            xf.write(text)
+    xf.write("\n")
+
+def link_pictures(part, part_images, index):
+    """
+    Point references to the pictures from `part_images' inside the element `part' to the 
+    binaries from the PictureIndex `index', so pictures with the same content share one binary.
+    """
+    ids = dict((make_id(img), img) for img in part_images)
+    for image in part.iter("image", markup.fb2_tag("image")):
+        href = image.get(markup.XLINK_HREF)
+        if href is None or not href.startswith("#") or href[1:] not in ids:
+            continue
+        image.set(markup.XLINK_HREF, "#%s" % index.picture_id(ids[href[1:]]))
+
+def count_elements(stats, e):
+    if stats is not None:
+        stats.count("elements", sum(1 for x in e.iter()))
+
+def action(cmd_args):
+    parser = OptionParser()
+    (options, args) = parser.parse_args(args=cmd_args)
+    
+    if options.out_filename is None:
+        options.out_filename = "result.fb2"
+
+    if len(args) != 1:
+        print_err("there must just one PROJECT_FILE")
+        exit(1)
+    
+    if options.zip_level < 0 or options.zip_level > 9:
+        print_err("zip compression level must be from 0 to 9")
+        exit(1)
+    out_filename, zipped = zip_output(options.out_filename, options.zip)
+    zip_level = None
+    if zipped:
+        zip_level = options.zip_level
+    optimizer = make_optimizer(options)
+     
+    stats = None
+    if options.profile or options.mem_report or options.profile_output is not None:
+        stats = CompileStats(options.mem_report)
+    
+    errors = list()
+    with stage(stats, "total"):
+        if options.check:
+            errors = check_project(args[0], stats)
+        else:
+            disk_cache, encoder, section_cache = open_caches(options.use_cache, options.cache_dir, 
+                                                             options.cache_size, options.incremental, optimizer,
+                                                             options.prefetch_threads)
+            compile_args = (args[0], out_filename, encoder, section_cache, options.jobs, stats, zip_level)
+            if options.cprofile is not None:
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(compile_project, *compile_args)
+                finally:
+                    profile.dump_stats(options.cprofile)
+            else:
+                compile_project(*compile_args)
             
-        
-        images = images.union(notes_images)
+            if disk_cache is not None:
+                with stage(stats, "cache"):
+                    disk_cache.evict()
+    
+    if options.profile:
+        print >>sys.stderr, stats.format()
+    if options.mem_report:
+        print >>sys.stderr, stats.format_memory()
+    if options.profile_output is not None:
+        import json
+        f = open(options.profile_output, "w")
+        try:
+            json.dump(stats.as_dict(), f, indent=2)
+        finally:
+            f.close()
+    
+    for message in errors:
+        print_err(message)
+    if len(errors) > 0:
+        exit(1)
+
+def open_caches(use_cache, cache_dir, cache_size, incremental, optimizer=None, prefetch_threads=0):
+    """
+    @return: tuple (disk_cache, encoder, section_cache), caches are None when disabled
+    """
+    disk_cache = None
+    if use_cache:
+        disk_cache = cache.DiskCache(cache_dir, cache_size)
+    encoder = images.PictureEncoder(disk_cache, optimizer, prefetch_threads)
+    section_cache = None
+    if incremental:
+        section_cache = disk_cache
+    return disk_cache, encoder, section_cache
+
+def check_project(project_filename, stats=None):
+    """
+    Check project `project_filename' with the same grammar as the compilation, but without
+    building xml and reading pictures: picture files are only looked up. Markup errors are
+    collected with their files and lines, errors of the project file are raised.
+    
+    @return: list of errors messages
+    """
+    with stage(stats, "project"):
+        project_props, authors, translators, doc_authors, doc_history, genres, book_sequences = \
+            project.parse_project_file(project_filename)
+    
+    ctx = markup.CompileContext(stats, check=True)
+    book_images = set()
+    with stage(stats, "description"):
+        if project_props['annotation-file'] is not None:
+            try:
+                markup.translate_annotation(ctx, project_props['annotation-file'])
+            except markup.InvalidMarkupError, e:
+                ctx.errors.append(e.message)
+        if project_props['cover-image'] is not None:
+            book_images.add(project_props['cover-image'])
+    
+    with stage(stats, "body"):
+        book_images.update(markup.check_body(ctx, project_props['content-file']))
+        for text in (", ".join(format_author(a) for a in authors), project_props['book-title']):
+            try:
+                markup.pprocess(ctx, "p", text)
+            except markup.InvalidMarkupError, e:
+                ctx.errors.append("Project file `%s': %s" % (project_filename, e.message))
+    
+    if project_props['notes-file'] is not None:
+        with stage(stats, "notes"):
+            try:
+                if not os.path.isfile(project_props['notes-file']):
+                    raise markup.InvalidMarkupError("Notes files not found")
+                notes_images, notes_sections = markup.translate_notes(ctx, project_props['notes-file'])
+                book_images.update(notes_images)
+                undefined = set()
+                for note_id in ctx.note_refs:
+                    if note_id not in notes_sections and note_id not in undefined:
+                        undefined.add(note_id)
+                        ctx.errors.append("Note id `%s' declared but not defined" % note_id)
+            except markup.InvalidMarkupError, e:
+                ctx.errors.append(e.message)
+    
+    with stage(stats, "binaries"):
+        for img in sorted(book_images):
+            try:
+                images.content_type(img)
+                images.picture_path(img, project_props['images-path'])
+            except markup.InvalidMarkupError, e:
+                ctx.errors.append(e.message)
+    
+    return ctx.errors
+
+def compile_project(project_filename, out_filename, encoder, section_cache=None, jobs=1, stats=None,
+                    zip_level=None, read_copy=False):
+    """
+    Compile project `project_filename' into FictionBook file `out_filename'. All compilation 
+    state is kept in the local CompileContext, so several projects can be compiled at once
+    in different threads. When `stats' is set, compilation stages statistics are added to it.
+    When `zip_level' is set, book is compressed into zip archive as it's written. When 
+    `read_copy' is set, source files are read into memory instead of mapping, so they can 
+    be safely rewritten during the compilation.
+    """
+    with stage(stats, "project"):
+        project_props, authors, translators, doc_authors, doc_history, genres, book_sequences = \
+            project.parse_project_file(project_filename)
+    
+    prefetcher = None
+    if encoder.prefetch_threads > 0:
+        prefetcher = images.PicturePrefetcher(encoder, project_props['images-path'], encoder.prefetch_threads)
     
+    # document is written into temporary file and renamed after successful compilation,
+    # so broken book never replaces previous result
+    tmp_filename = "%s.tmp" % out_filename
+    outf = open(tmp_filename, "wb")
+    try:
+        out = outf
+        if zip_level is not None:
+            out = ZipEntryWriter(outf, zip_entry_name(out_filename), zip_level)
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        with etree.xmlfile(out, encoding="utf-8") as xf:
+            with xf.element("FictionBook", nsmap=NSMAP):
+                xf.write("\n")
+                write_book(xf, project_props, authors, translators, doc_authors, doc_history, 
+                           genres, book_sequences, encoder, section_cache, jobs, stats, prefetcher,
+                           read_copy)
+        if zip_level is not None:
+            with stage(stats, "serialization"):
+                out.close()
+        outf.close()
+    except:
+        outf.close()
+        os.remove(tmp_filename)
+        raise
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        encoder.close()
+    
+    if os.path.exists(out_filename):
+        os.remove(out_filename)
+    os.rename(tmp_filename, out_filename)
+
+def write_book(xf, project_props, authors, translators, doc_authors, doc_history, genres, book_sequences, 
+               encoder, section_cache=None, jobs=1, stats=None, prefetcher=None, read_copy=False):
+    """
+    Generate book parts and write each one into the xmlfile context `xf' as soon as it is ready,
+    so only one part of the book is kept in memory at a time. Picture references of each part
+    are pointed to the shared binaries before the part is written. When `prefetcher' is set,
+    pictures are requested from it as soon as they are found and taken from it when written.
+    """
+    ctx = markup.CompileContext(stats)
+    ctx.read_copy = read_copy
+    # source of pictures digests and encoded pictures
+    pictures = encoder
+    if prefetcher is not None:
+        ctx.prefetcher = prefetcher
+        pictures = prefetcher
+        if project_props['cover-image'] is not None:
+            prefetcher.request(project_props['cover-image'])
+    index = images.PictureIndex(project_props['images-path'], pictures)
+    with stage(stats, "description"):
+        desc, cover_image_name = build_description(ctx, project_props, authors, translators, doc_authors, 
+                                                   doc_history, genres, book_sequences, section_cache)
     if cover_image_name is not None:
-        images.add(cover_image_name)
-    
-    for img in images:
-        img_path = os.path.join(project_props['images-path'], img)
-        img_id = make_id(img)
-        if not os.path.isfile(img_path):
-            raise markup.InvalidMarkupError("Picture file `%s' not found." % img_path)
-        # encode img file
-        f = open(img_path, "rb")
-        b = base64_encode(f.read())
-        f.close()
-        
-        img_name_lo = img.lower()
-        content_type = None
-        if img_name_lo.endswith(".jpg"):
-            content_type = "image/jpeg"
-        elif img_name_lo.endswith(".png"):
-            content_type = "image/png"
-        elif img_name_lo.endswith(".gif"):
-            content_type = "image/gif"
-        else:
-            raise markup.InvalidMarkupError("Unknown picture `%s' format." % img)
-        
-        
-        bin = append_element(root, "binary", b, attrs={'id': img_id, 'content-type': content_type})
-        root.append(bin)
+        with stage(stats, "binaries"):
+            link_pictures(desc, [cover_image_name], index)
+    count_elements(stats, desc)
+    with stage(stats, "serialization"):
+        xf.write(desc, pretty_print=True)
+    del desc
+    
+    with stage(stats, "body"):
+        # prepare book title
+        title = markup.fbe("title")
+        # append authors list
+        authors_list = [format_author(a) for a in authors]
+        title.append(markup.pprocess(ctx, "p", ", ".join(authors_list)))
+    
+        # append book title
+        title.append(markup.pprocess(ctx, "p", project_props['book-title']))
+        sections = markup.translate_body_sections(ctx, project_props['content-file'], 
+                                                  section_cache, jobs)
+    
+    with xf.element("body", nsmap=NSMAP):
+        if stats is not None:
+            # <body> element itself
+            stats.count("elements")
+        count_elements(stats, title)
+        with stage(stats, "serialization"):
+            xf.write(title, pretty_print=True)
+        del title
         
-    #if project_props['cover-image'] is not None and project_props['cover-image'] not in images:
-    #    bin = append_element(root, "binary", b, attrs={'id': 'img_%04d' % img_id, 'content-type': content_type})
+        # each top level section is written as soon as it's translated
+        while True:
+            with stage(stats, "body"):
+                try:
+                    sx, section_images = next(sections)
+                except StopIteration:
+                    break
+            with stage(stats, "binaries"):
+                link_pictures(sx, section_images, index)
+            count_elements(stats, sx)
+            with stage(stats, "serialization"):
+                xf.write(sx, pretty_print=True)
+            del sx
+
+    # process notes
+    if project_props['notes-file'] is not None:
+        with stage(stats, "notes"):
+            notes_body, notes_images = build_notes_body(ctx, project_props['notes-file'], section_cache)
+        with stage(stats, "binaries"):
+            link_pictures(notes_body, notes_images, index)
+        count_elements(stats, notes_body)
+        with stage(stats, "serialization"):
+            xf.write(notes_body, pretty_print=True)
+        del notes_body
+    
+    if encoder.optimizer is not None:
+        with stage(stats, "optimization"):
+            encoder.prepare([(img, images.picture_path(img, project_props['images-path'])) 
+                             for img in index.pictures], encoder.optimizer.jobs)
     
-    outf = codecs.open(options.out_filename, mode="w", encoding="utf-8")
-    outf.write('<?xml version="1.0" encoding="utf-8"?>\n')
-    outf.write(etree.tostring(root, pretty_print=True, xml_declaration=False, encoding=unicode))
-    outf.close()
\ No newline at end of file
+    with stage(stats, "binaries"):
+        for img in index.pictures:
+            write_binary(xf, img, project_props['images-path'], pictures, stats)
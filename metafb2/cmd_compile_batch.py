@@ -0,0 +1,200 @@
+"""
+"""
+
+import optparse
+import os
+import os.path
+import glob
+import time
+import itertools
+import multiprocessing
+from .print_ext import print_err
+from .print_ext import print_warning
+from . import project
+from . import markup
+from . import cache
+from .cmd_compile import add_cache_options
+from .cmd_compile import add_zip_options
+from .cmd_compile import add_image_options
+from .cmd_compile import make_optimizer
+from .cmd_compile import zip_output
+from .cmd_compile import open_caches
+from .cmd_compile import compile_project
+
+# name of the book written into the project directory, the same as `compile' default
+DEFAULT_OUT_FILENAME = "result.fb2"
+
+class OptionParser(optparse.OptionParser):
+    def __init__(self):
+        optparse.OptionParser.__init__(self,
+            usage="%prog compile-batch [OPTIONS] <PROJECT_FILE|PATTERN>...")
+        self.add_option("-m", "--manifest", dest="manifest",
+                        help="read project files from FILE, one file or pattern per line", metavar="FILE")
+        self.add_option("-d", "--output-dir", dest="output_dir",
+                        help="write generated books into DIR, each book is named after its project "
+                             "directory (default: write %s into the project directory)" % DEFAULT_OUT_FILENAME,
+                        metavar="DIR")
+        self.add_option("-j", "--jobs", dest="jobs", type="int", default=multiprocessing.cpu_count(),
+                        help="compile projects on N worker processes (default: %default)", metavar="N")
+        add_zip_options(self)
+        add_image_options(self)
+        add_cache_options(self)
+
+def read_manifest(filename):
+    """
+    Read manifest file, empty lines and lines started with `#' are skipped, relative
+    paths are resolved against the manifest directory.
+
+    @return: list of project files and patterns
+    """
+    base = os.path.dirname(os.path.abspath(filename))
+    patterns = list()
+    f = open(filename, "r")
+    try:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            patterns.append(os.path.join(base, line))
+    finally:
+        f.close()
+    return patterns
+
+def expand_projects(patterns):
+    """
+    @return: list of absolute paths to the project files, each file occurs once
+    """
+    projects = list()
+    seen = set()
+    for p in patterns:
+        if glob.has_magic(p):
+            matches = sorted(glob.glob(p))
+            if len(matches) == 0:
+                print_warning("No project files match `%s'" % p)
+        else:
+            matches = [p]
+        for m in matches:
+            m = os.path.abspath(m)
+            if m not in seen:
+                seen.add(m)
+                projects.append(m)
+    return projects
+
+def output_filename(project_filename, output_dir, use_zip=False):
+    """
+    @return: absolute path to the book generated from `project_filename'
+    """
+    project_dir = os.path.dirname(project_filename)
+    if output_dir is None:
+        out_filename = os.path.join(project_dir, DEFAULT_OUT_FILENAME)
+    else:
+        out_filename = os.path.join(os.path.abspath(output_dir), "%s.fb2" % os.path.basename(project_dir))
+    return zip_output(out_filename, use_zip)[0]
+
+def compile_job(job):
+    """
+    Compile single project, project paths are resolved relative to the project directory
+    like in `compile' started from that directory. Errors are returned instead of raised,
+    so a broken book doesn't stop the batch.
+
+    @return: tuple (project_filename, error, elapsed, book_size), error is None on success
+    """
+    (project_filename, out_filename, zip_level, optimizer, use_cache, cache_dir, cache_size, incremental,
+     prefetch_threads) = job
+    started = time.time()
+    error = None
+    book_size = 0
+    cwd = os.getcwd()
+    try:
+        os.chdir(os.path.dirname(project_filename))
+        disk_cache, encoder, section_cache = open_caches(use_cache, cache_dir, cache_size, incremental,
+                                                         optimizer, prefetch_threads)
+        compile_project(project_filename, out_filename, encoder, section_cache, zip_level=zip_level)
+        book_size = os.path.getsize(out_filename)
+    except project.InvalidProjectError, e:
+        error = e.message
+    except markup.InvalidMarkupError, e:
+        error = e.message
+    except Exception, e:
+        error = u"%s: %s" % (e.__class__.__name__, e)
+    finally:
+        os.chdir(cwd)
+
+    return project_filename, error, time.time() - started, book_size
+
+def action(cmd_args):
+    parser = OptionParser()
+    (options, args) = parser.parse_args(args=cmd_args)
+
+    patterns = list(args)
+    if options.manifest is not None:
+        patterns.extend(read_manifest(options.manifest))
+
+    if len(patterns) == 0:
+        print_err("there must be at least one PROJECT_FILE or manifest")
+        exit(1)
+
+    if options.jobs < 1:
+        print_err("number of jobs must be positive")
+        exit(1)
+
+    if options.zip_level < 0 or options.zip_level > 9:
+        print_err("zip compression level must be from 0 to 9")
+        exit(1)
+    zip_level = None
+    if options.zip:
+        zip_level = options.zip_level
+    optimizer = make_optimizer(options)
+
+    projects = expand_projects(patterns)
+    if options.output_dir is not None and not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    jobs = list()
+    outputs = dict()
+    for p in projects:
+        out_filename = output_filename(p, options.output_dir, options.zip)
+        if out_filename in outputs:
+            print_err("projects `%s' and `%s' are both compiled into `%s'" % (outputs[out_filename], p, out_filename))
+            exit(1)
+        outputs[out_filename] = p
+        jobs.append((p, out_filename, zip_level, optimizer, options.use_cache, options.cache_dir, options.cache_size,
+                     options.incremental, options.prefetch_threads))
+
+    started = time.time()
+    failed = 0
+    total_size = 0
+    pool = None
+    if options.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)))
+        results = pool.imap_unordered(compile_job, jobs)
+    else:
+        results = itertools.imap(compile_job, jobs)
+
+    try:
+        for project_filename, error, elapsed, book_size in results:
+            if error is None:
+                total_size += book_size
+                print "ok      %s (%.2f s)" % (project_filename, elapsed)
+            else:
+                failed += 1
+                print "FAILED  %s (%.2f s)" % (project_filename, elapsed)
+                print_err(error)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - started, 1e-6)
+
+    if options.use_cache:
+        cache.DiskCache(options.cache_dir, options.cache_size).evict()
+
+    compiled = len(jobs) - failed
+    print "%d books compiled, %d failed in %.2f s: %.2f books/s, %.2f MB/s" % \
+        (compiled, failed, elapsed, compiled / elapsed, total_size / elapsed / (1024 * 1024))
+
+    if failed > 0:
+        exit(1)
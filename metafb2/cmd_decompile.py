@@ -0,0 +1,70 @@
+"""
+Conversion of FictionBook2 file into metafb2 project
+"""
+import optparse
+import os
+import os.path
+import zipfile
+from sys import exit
+from lxml import etree
+from .print_ext import print_err
+from .print_ext import print_warning
+from .decompile import Decompiler
+
+class OptionParser(optparse.OptionParser):
+    def __init__(self):
+        optparse.OptionParser.__init__(self, usage="%prog decompile [OPTIONS] <FB2_FILE> <DIRECTORY>")
+        self.add_option("-f", "--force", dest="force_overwrite",
+                        action="store_true", default=False,
+                        help="Overwrite existing project files in the specified directory")
+
+def open_book(filename):
+    """
+    @return: file object of the FictionBook2 file, the first .fb2 entry is opened if `filename' is zip archive
+    """
+    if zipfile.is_zipfile(filename):
+        archive = zipfile.ZipFile(filename)
+        for name in archive.namelist():
+            if name.lower().endswith(".fb2"):
+                return archive.open(name)
+        raise IOError("There is no .fb2 file in the archive `%s'" % filename)
+    return open(filename, "rb")
+
+def action(cmd_args):
+    parser = OptionParser()
+    (options, args) = parser.parse_args(args=cmd_args)
+
+    if len(args) != 2:
+        print_err("Path to the FictionBook2 file and to the target directory are required")
+        exit(1)
+
+    fb2_filename, target_dir = args
+    decompiler = Decompiler(target_dir)
+
+    if not options.force_overwrite:
+        for fn in decompiler.output_files():
+            if os.path.exists(os.path.join(target_dir, fn)):
+                print_err("File `%s' already exists, use --force to overwrite it" % os.path.join(target_dir, fn))
+                exit(1)
+
+    try:
+        f = open_book(fb2_filename)
+        try:
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            decompiler.decompile(f)
+        finally:
+            f.close()
+    except (IOError, OSError, zipfile.BadZipfile), e:
+        print_err(e)
+        exit(1)
+    except etree.XMLSyntaxError, e:
+        print_err("Invalid FictionBook2 file `%s': %s" % (fb2_filename, e))
+        exit(1)
+
+    for tag, n in sorted(decompiler.converted.items()):
+        print_warning("%d `%s' element(s) converted into paragraphs" % (n, tag))
+    for tag, n in sorted(decompiler.dropped.items()):
+        print_warning("%d `%s' element(s) skipped" % (n, tag))
+    for name in decompiler.missing_pictures():
+        print_warning(u"Picture `%s' is referenced but not found in the book, reference is removed" % name)
@@ -7,7 +7,6 @@ from sys import exit
 import os.path
 import shutil
 import codecs
-import uuid
 import time
 
 class OptionParser(optparse.OptionParser):
@@ -48,6 +47,8 @@ def action(cmd_args):
     target_filename = os.path.join(target_dir, "project.mfb2")
     
     if options.force_overwrite or not os.path.exists(target_filename):
+        # uuid loads ctypes, so it's imported only when it's needed
+        import uuid
         # copy file
         in_f = codecs.open(sample_filename, "r", encoding="utf-8")
         text = in_f.read()
@@ -0,0 +1,183 @@
+"""
+"""
+
+import optparse
+import os
+import os.path
+import stat
+import sys
+import time
+from .print_ext import print_err
+from .print_ext import print_warning
+from . import project
+from . import markup
+from . import cache
+from .cmd_compile import add_cache_options
+from .cmd_compile import add_image_options
+from .cmd_compile import make_optimizer
+from .cmd_compile import open_caches
+from .cmd_compile import compile_project
+
+try:
+    import pyinotify
+    # events which could change watched files
+    INOTIFY_MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+                    pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_ATTRIB)
+except ImportError:
+    pyinotify = None
+
+class OptionParser(optparse.OptionParser):
+    def __init__(self):
+        optparse.OptionParser.__init__(self, usage="%prog watch [OPTIONS] <PROJECT_FILE>")
+        self.add_option("-o", "--output", dest="out_filename", default="result.fb2",
+                        help="write generated FictionBook XML to FILE (default: %default)", metavar="FILE")
+        self.add_option("--poll", dest="poll", action="store_true", default=False,
+                        help="check files periodically even if inotify is available")
+        self.add_option("--interval", dest="interval", type="float", default=0.1,
+                        help="check files every SECONDS when polling (default: %default)", metavar="SECONDS")
+        add_image_options(self)
+        add_cache_options(self)
+
+def input_paths(project_filename):
+    """
+    @return: list of files and directories the book is compiled from or None if project file is invalid
+    """
+    try:
+        project_props = project.parse_project_file(project_filename)[0]
+    except project.InvalidProjectError:
+        return None
+
+    paths = [project_filename] + project_props['content-file']
+    for k in ("notes-file", "annotation-file", "images-path"):
+        if project_props[k] is not None:
+            paths.append(project_props[k])
+    return paths
+
+def take_snapshot(paths):
+    """
+    @return: list of files states (name, size and mtime), directories are listed
+    """
+    state = list()
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            state.append((p, None, None))
+            continue
+
+        state.append((p, st.st_size, st.st_mtime))
+        if stat.S_ISDIR(st.st_mode):
+            state.extend(take_snapshot([os.path.join(p, fn) for fn in sorted(os.listdir(p))]))
+    return state
+
+def _ignore_event(event):
+    pass
+
+class PollingWatcher:
+    """
+    Waits for fixed interval, changes are detected by comparing snapshots.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+
+    def watch(self, paths):
+        pass
+
+    def wait(self):
+        time.sleep(self.interval)
+
+class InotifyWatcher:
+    """
+    Waits until something is changed in the directories of the watched files.
+    """
+    def __init__(self, timeout=1.0):
+        """
+        @param timeout: maximum wait time in seconds, directories which don't exist yet
+                        are not watched and checked only on timeout
+        """
+        self.timeout = timeout
+        self.__wm = pyinotify.WatchManager()
+        self.__notifier = pyinotify.Notifier(self.__wm, default_proc_fun=_ignore_event)
+        self.__dirs = set()
+
+    def watch(self, paths):
+        for p in paths:
+            if os.path.isdir(p):
+                dirname = p
+            else:
+                dirname = os.path.dirname(p) or "."
+            dirname = os.path.abspath(dirname)
+            if dirname in self.__dirs or not os.path.isdir(dirname):
+                continue
+            wdd = self.__wm.add_watch(dirname, INOTIFY_MASK)
+            if wdd.get(dirname, -1) >= 0:
+                self.__dirs.add(dirname)
+
+    def wait(self):
+        if self.__notifier.check_events(timeout=int(self.timeout * 1000)):
+            self.__notifier.read_events()
+            self.__notifier.process_events()
+
+def build(project_filename, out_filename, encoder, section_cache):
+    """
+    Compile the book and report result.
+    """
+    started = time.time()
+    try:
+        # source files may be rewritten in place during the build
+        compile_project(project_filename, out_filename, encoder, section_cache, read_copy=True)
+    except project.InvalidProjectError, e:
+        print_err(e.message)
+    except markup.InvalidMarkupError, e:
+        print_err(e.message)
+    except (IOError, OSError), e:
+        print_err(e)
+    except Exception, e:
+        # source files are edited while watching, keep running after any failed build
+        print_err("%s: %s" % (e.__class__.__name__, e))
+    else:
+        print "%s: compiled in %d ms" % (out_filename, (time.time() - started) * 1000)
+    section_cache.sweep()
+    sys.stdout.flush()
+
+def action(cmd_args):
+    parser = OptionParser()
+    (options, args) = parser.parse_args(args=cmd_args)
+
+    if len(args) != 1:
+        print_err("there must just one PROJECT_FILE")
+        exit(1)
+    project_filename = args[0]
+    disk_cache, encoder, disk_section_cache = open_caches(options.use_cache, options.cache_dir,
+                                                          options.cache_size, options.incremental,
+                                                          make_optimizer(options), options.prefetch_threads)
+    # translated sections are kept in memory between compilations
+    section_cache = cache.MemoryCache(disk_section_cache)
+
+    if pyinotify is not None and not options.poll:
+        watcher = InotifyWatcher()
+    else:
+        if pyinotify is None and not options.poll:
+            print_warning("pyinotify is not available, files are checked every %g s" % options.interval)
+        watcher = PollingWatcher(options.interval)
+
+    paths = [project_filename]
+    last_snapshot = None
+    try:
+        while True:
+            snapshot = take_snapshot(paths)
+            if snapshot != last_snapshot:
+                build(project_filename, options.out_filename, encoder, section_cache)
+                # keep watching previous files while project file is broken
+                new_paths = input_paths(project_filename)
+                if new_paths is not None and new_paths != paths:
+                    paths = new_paths
+                    snapshot = take_snapshot(paths)
+                last_snapshot = snapshot
+                watcher.watch(paths)
+            watcher.wait()
+    except KeyboardInterrupt:
+        pass
+
+    if disk_cache is not None:
+        disk_cache.evict()
@@ -0,0 +1,654 @@
+"""
+Conversion of FictionBook2 files into metafb2 projects
+"""
+import binascii
+import codecs
+import os
+import os.path
+import re
+import unicodedata
+from base64 import urlsafe_b64decode
+from lxml import etree
+from .xml import XLINK_NAMESPACE
+from .xml import make_id
+from .errors import InvalidMarkupError
+from . import images
+
+XLINK_HREF = "{%s}href" % XLINK_NAMESPACE
+WHITESPACE_RE = re.compile(u"[ \t\r\n]+")
+# first characters of the lines which are not plain text in the markup
+SPECIAL_LINE_CHARS = u"=@#"
+NBSP = u"\u00a0"
+
+# blocks allowed inside the markup blocks, other blocks are converted into paragraphs
+SECTION_BLOCKS = frozenset(["p", "empty-line", "subtitle", "image", "cite", "poem"])
+ANNOTATION_BLOCKS = frozenset(["p", "empty-line", "subtitle", "cite", "poem"])
+ANN_BLOCKS = frozenset(["p", "empty-line", "subtitle", "cite"])
+EPIGRAPH_BLOCKS = frozenset(["p", "empty-line"])
+CITE_BLOCKS = frozenset(["p", "empty-line", "subtitle"])
+# elements with the text which are kept when unsupported block is converted into paragraphs
+TEXT_ELEMENTS = frozenset(["p", "v", "subtitle", "text-author", "td", "th"])
+
+def local_name(tag):
+    """
+    @return: tag name without namespace
+    """
+    return tag.rpartition("}")[2]
+
+def children(e, name):
+    """
+    @return: list of child elements of `e' with the local name `name'
+    """
+    return [c for c in e if isinstance(c.tag, basestring) and local_name(c.tag) == name]
+
+def child_text(e, name):
+    """
+    @return: text of the first child element of `e' with the local name `name' or None
+    """
+    if e is None:
+        return None
+    for c in children(e, name):
+        return plain_text(c)
+    return None
+
+def plain_text(e):
+    """
+    @return: text of the element and its descendants with whitespace collapsed
+    """
+    return WHITESPACE_RE.sub(u" ", u"".join(e.itertext())).strip(u" ")
+
+def source_name(fb2_id):
+    """
+    @return: original name of the picture or the note with id `fb2_id' if id is made by make_id(),
+             otherwise the id itself
+    """
+    try:
+        name = urlsafe_b64decode(str(fb2_id) + "=" * (-len(fb2_id) % 4)).decode("utf-8")
+    except (TypeError, ValueError, binascii.Error):
+        return fb2_id
+    if name == u"" or make_id(name) != fb2_id:
+        return fb2_id
+    for c in name:
+        if unicodedata.category(c)[0] in ("C", "Z") and c != u" ":
+            return fb2_id
+    return name
+
+def escape_line(text):
+    """
+    @return: text line which is never taken for a command, comment or section title
+    """
+    if text[:1] in SPECIAL_LINE_CHARS:
+        return NBSP + text
+    return text
+
+def project_value(v):
+    """
+    @return: value written to the project file on a single line
+    """
+    v = WHITESPACE_RE.sub(u" ", v).strip(u" ")
+    # ConfigParser interpolates references to the other keys until there are none left,
+    # so they can't be escaped
+    return v.replace(u"%(", u"% (")
+
+class SectionState:
+    """
+    Section which is being converted.
+    """
+    def __init__(self, e, level, section_id, inline=False):
+        self.element = e
+        self.level = level
+        self.id = section_id
+        # section which is written as a part of its parent text: title becomes subtitles
+        self.inline = inline
+        self.title = list()
+        self.header_written = False
+        # picture which must be written after the annotation
+        self.pending_image = None
+        # set when the first block of the section text is written
+        self.blocks_started = False
+
+class Decompiler:
+    """
+    Converts FictionBook2 file into metafb2 project in the directory `target_dir'. File is read
+    with iterparse and each block is written and dropped from the tree as soon as it ends,
+    binaries are decoded straight into picture files, so memory usage doesn't depend on
+    the book size.
+
+    Text of the unnamed bodies goes to content.txt, text of the named bodies (notes, comments)
+    goes to notes.txt, annotation goes to annotation.txt and pictures go to the images directory.
+    Internal links become note references. Elements which have no metafb2 markup are counted
+    in `converted' when their text is kept as paragraphs and in `dropped' otherwise.
+    """
+
+    CONTENT_FILE = "content.txt"
+    NOTES_FILE = "notes.txt"
+    ANNOTATION_FILE = "annotation.txt"
+    PROJECT_FILE = "project.mfb2"
+    IMAGES_DIR = "images"
+
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        # tag name -> count
+        self.converted = dict()
+        self.dropped = dict()
+        # file name -> opened output file
+        self.__outputs = dict()
+        self.__written = set()
+        self.__out = None
+        self.__notes = False
+        self.__body = None
+        self.__sections = list()
+        self.__notes_count = 0
+        # picture id -> file name
+        self.__pictures = dict()
+        self.__picture_names = set()
+        # ids of pictures written into the images directory
+        self.__binaries = set()
+        # old picture name -> new name, for pictures renamed after their references are written
+        self.__renamed = dict()
+        self.__description = None
+        self.__cover = None
+
+    def output_files(self):
+        """
+        @return: names of the files written by the decompiler
+        """
+        return (self.PROJECT_FILE, self.CONTENT_FILE, self.NOTES_FILE, self.ANNOTATION_FILE)
+
+    def missing_pictures(self):
+        """
+        @return: names of pictures which are referenced but not embedded into the book
+        """
+        return sorted(name for fb2_id, name in self.__pictures.iteritems() if fb2_id not in self.__binaries)
+
+    def decompile(self, f):
+        """
+        Convert FictionBook2 file object `f'.
+        """
+        try:
+            for event, e in etree.iterparse(f, events=("start", "end"), huge_tree=True):
+                if not isinstance(e.tag, basestring):
+                    continue
+                tag = local_name(e.tag)
+                if event == "start":
+                    if tag == "body":
+                        self.__start_body(e)
+                    elif tag == "section" and self.__body is not None:
+                        self.__start_section(e)
+                    continue
+
+                parent = e.getparent()
+                if tag == "section" and self.__body is not None:
+                    self.__end_section(e)
+                elif self.__sections and parent is self.__sections[-1].element:
+                    self.__section_block(e, tag)
+                elif tag == "body":
+                    self.__body = None
+                elif self.__body is not None and parent is self.__body:
+                    # book title is made from the project file, epigraphs and pictures of the body
+                    # have no markup
+                    if tag != "title":
+                        self.__count(self.dropped, tag)
+                elif tag == "description":
+                    self.__description = e
+                    self.__write_annotation()
+                    # description is small, it's converted into project file at the end
+                    continue
+                elif tag == "binary":
+                    self.__write_binary(e)
+                elif parent is not None and parent.getparent() is not None:
+                    # inner element, it's converted with its block
+                    continue
+
+                self.__release(e)
+
+            self.__rename_pictures()
+            self.__write_project()
+        finally:
+            for out in self.__outputs.values():
+                out.close()
+
+    def __release(self, e):
+        e.clear()
+        parent = e.getparent()
+        if parent is not None:
+            while e.getprevious() is not None:
+                del parent[0]
+
+    def __count(self, counter, tag):
+        counter[tag] = counter.get(tag, 0) + 1
+
+    def __output(self, filename):
+        out = self.__outputs.get(filename)
+        if out is None:
+            out = codecs.open(os.path.join(self.target_dir, filename), "w", encoding="utf-8")
+            self.__outputs[filename] = out
+            self.__written.add(filename)
+        return out
+
+    def __line(self, text=u""):
+        self.__out.write(text)
+        self.__out.write(u"\n")
+
+    def __start_body(self, e):
+        self.__body = e
+        self.__notes = e.get("name") is not None
+        if self.__notes:
+            self.__out = self.__output(self.NOTES_FILE)
+        else:
+            self.__out = self.__output(self.CONTENT_FILE)
+
+    def __start_section(self, e):
+        if not self.__sections:
+            self.__sections.append(SectionState(e, 1, e.get("id")))
+            return
+        parent = self.__sections[-1]
+        self.__write_header(parent)
+        self.__flush_image(parent)
+        # markup section has either text or subsections, so subsection following the text
+        # and nested note are written as a part of the parent text
+        inline = parent.inline or parent.blocks_started or self.__notes
+        if inline:
+            if not self.__notes:
+                self.__count(self.converted, "section")
+            parent.blocks_started = True
+        self.__sections.append(SectionState(e, parent.level + 1, e.get("id"), inline))
+
+    def __end_section(self, e):
+        s = self.__sections.pop()
+        self.__write_header(s)
+        self.__flush_image(s)
+
+    def __write_header(self, s):
+        if s.header_written:
+            return
+        s.header_written = True
+
+        if s.inline:
+            for t in s.title:
+                self.__line(u"@s:%s" % t)
+                self.__line()
+            return
+
+        if self.__notes:
+            # notes titles are replaced with numbers by the compiler
+            self.__line((u"= %s" % u" ".join(s.title)).rstrip(u" "))
+            note_id = s.id
+            if note_id is None:
+                self.__notes_count += 1
+                note_id = "note-%d" % self.__notes_count
+            self.__line(u"@id:%s" % source_name(note_id))
+            self.__line()
+            return
+
+        for t in s.title or [u""]:
+            self.__line((u"%s %s" % (u"=" * s.level, t)).rstrip(u" "))
+        if s.id is not None:
+            self.__line(u"@id:%s" % source_name(s.id))
+        self.__line()
+
+    def __flush_image(self, s):
+        if s.pending_image is not None:
+            self.__line(u"@img:%s" % s.pending_image)
+            self.__line()
+            s.pending_image = None
+
+    def __section_block(self, e, tag):
+        """
+        Write the block `e' of the current section.
+        """
+        s = self.__sections[-1]
+        # blocks which start the section in FictionBook2, the markup has them in the other order
+        # (epigraphs, annotation, picture) and doesn't allow them in the inline sections
+        leading = not s.blocks_started and not s.inline
+        if tag == "title" and not s.header_written:
+            s.title = [self.__inline_text(p) for p in children(e, "p")]
+            s.title = [t for t in s.title if t != u""]
+            self.__write_header(s)
+        elif tag == "epigraph" and leading:
+            self.__write_header(s)
+            self.__line(u"@e")
+            self.__write_blocks([c for c in e if local_name(c.tag) != "text-author"], EPIGRAPH_BLOCKS)
+            self.__line(u"@e/%s" % u", ".join(self.__inline_text(a) for a in children(e, "text-author")))
+            self.__line()
+        elif tag == "image" and leading and s.pending_image is None:
+            self.__write_header(s)
+            s.pending_image = self.__picture_name(e)
+        elif tag == "annotation" and leading:
+            self.__write_header(s)
+            self.__line(u"@ann")
+            self.__write_blocks(e, ANN_BLOCKS)
+            self.__line(u"@ann/")
+            self.__line()
+            self.__flush_image(s)
+            s.blocks_started = True
+        else:
+            self.__write_header(s)
+            self.__flush_image(s)
+            self.__write_block(e, SECTION_BLOCKS)
+            s.blocks_started = True
+
+    def __write_blocks(self, elements, allowed):
+        for e in elements:
+            if isinstance(e.tag, basestring):
+                self.__write_block(e, allowed)
+
+    def __write_block(self, e, allowed):
+        """
+        Write block `e', blocks which are not in the set `allowed' are converted into paragraphs.
+        """
+        tag = local_name(e.tag)
+        if tag not in allowed:
+            self.__write_converted(e, tag)
+        elif tag == "p":
+            self.__write_para(e)
+        elif tag == "empty-line":
+            self.__line(u"@empty-line")
+            self.__line()
+        elif tag == "subtitle":
+            text = self.__inline_text(e)
+            if text != u"":
+                self.__line(u"@s:%s" % text)
+                self.__line()
+        elif tag == "image":
+            self.__line(u"@img:%s" % self.__picture_name(e))
+            self.__line()
+        elif tag == "cite":
+            self.__line(u"@cite")
+            self.__write_blocks([c for c in e if local_name(c.tag) != "text-author"], CITE_BLOCKS)
+            self.__line(u"@cite/%s" % u", ".join(self.__inline_text(a) for a in children(e, "text-author")))
+            self.__line()
+        elif tag == "poem":
+            self.__write_poem(e)
+
+    def __write_converted(self, e, tag):
+        """
+        Write text of the element which has no markup as paragraphs.
+        """
+        paras = [d for d in e.iter() if isinstance(d.tag, basestring) and local_name(d.tag) in TEXT_ELEMENTS]
+        if len(paras) == 0:
+            self.__count(self.dropped, tag)
+            return
+        self.__count(self.converted, tag)
+        for p in paras:
+            self.__write_para(p)
+
+    def __write_para(self, e):
+        text = self.__inline_text(e)
+        if text != u"":
+            self.__line(escape_line(text))
+            self.__line()
+
+    def __write_poem(self, e):
+        self.__line(u"@poem")
+        authors = list()
+        first = True
+        for c in e:
+            if not isinstance(c.tag, basestring):
+                continue
+            tag = local_name(c.tag)
+            if tag == "text-author":
+                authors.append(self.__inline_text(c))
+                continue
+            if tag not in ("title", "stanza"):
+                self.__count(self.dropped, "poem/%s" % tag)
+                continue
+            # poem title is kept as a separate stanza
+            lines = [self.__inline_text(v) for v in c.iter()
+                     if isinstance(v.tag, basestring) and local_name(v.tag) in ("p", "v", "subtitle")]
+            lines = [v for v in lines if v != u""]
+            if len(lines) == 0:
+                continue
+            if not first:
+                self.__line()
+            first = False
+            for v in lines:
+                self.__line(escape_line(v))
+        self.__line(u"@poem/%s" % u", ".join(authors))
+        self.__line()
+
+    def __inline_text(self, e):
+        """
+        @return: text of the element with the inline markup
+        """
+        parts = list()
+        self.__append_inline(e, parts)
+        return WHITESPACE_RE.sub(u" ", u"".join(parts)).strip(u" ")
+
+    def __append_inline(self, e, parts):
+        if e.text:
+            parts.append(e.text)
+        for c in e:
+            if isinstance(c.tag, basestring):
+                tag = local_name(c.tag)
+                if tag == "strong":
+                    self.__append_marked(c, parts, u"**", u"**")
+                elif tag == "emphasis":
+                    self.__append_marked(c, parts, u"//", u"//")
+                elif tag in ("sup", "sub"):
+                    self.__append_marked(c, parts, u"<%s>" % tag, u"</%s>" % tag)
+                elif tag == "a" and c.get("type") == "note" and (c.get(XLINK_HREF) or "").startswith("#"):
+                    parts.append(u"{{%s}}" % source_name(c.get(XLINK_HREF)[1:]))
+                elif tag == "image":
+                    self.__count(self.dropped, "inline image")
+                else:
+                    # links, styles and other inline elements are kept as plain text
+                    self.__append_inline(c, parts)
+            if c.tail:
+                parts.append(c.tail)
+
+    def __append_marked(self, e, parts, begin, end):
+        inner = list()
+        self.__append_inline(e, inner)
+        text = u"".join(inner)
+        if text.strip() == u"":
+            parts.append(text)
+        else:
+            parts.extend((begin, text, end))
+
+    def __picture_name(self, e):
+        """
+        @return: name of the picture file referenced by the image element `e'
+        """
+        href = e.get(XLINK_HREF) or ""
+        return self.__picture_file(href.lstrip("#"))
+
+    def __picture_file(self, fb2_id):
+        """
+        @return: name of the file of the picture with id `fb2_id'
+        """
+        name = self.__pictures.get(fb2_id)
+        if name is not None:
+            return name
+        name = source_name(fb2_id).replace(u"/", u"_").replace(u"\\", u"_").lstrip(u".")
+        if name == u"":
+            name = u"picture"
+        name = self.__unique_picture_name(name)
+        self.__pictures[fb2_id] = name
+        return name
+
+    def __unique_picture_name(self, name):
+        base, ext = os.path.splitext(name)
+        n = 1
+        while name in self.__picture_names:
+            n += 1
+            name = u"%s-%d%s" % (base, n, ext)
+        self.__picture_names.add(name)
+        return name
+
+    def __write_binary(self, e):
+        fb2_id = e.get("id")
+        if fb2_id is None or fb2_id in self.__binaries:
+            self.__count(self.dropped, "binary")
+            return
+        name = self.__picture_file(fb2_id)
+        try:
+            images.content_type(name)
+        except InvalidMarkupError:
+            # compiler detects picture format by the file name extension
+            ext = dict((ct, ext) for ext, ct in images.CONTENT_TYPES).get(e.get("content-type"))
+            if ext is not None:
+                new_name = self.__unique_picture_name(name + ext)
+                self.__renamed[name] = new_name
+                self.__pictures[fb2_id] = name = new_name
+
+        images_dir = os.path.join(self.target_dir, self.IMAGES_DIR)
+        if not os.path.isdir(images_dir):
+            os.makedirs(images_dir)
+        f = open(os.path.join(images_dir, name), "wb")
+        try:
+            images.write_base64_text(e.text or "", f)
+        except (ValueError, binascii.Error):
+            f.close()
+            os.remove(os.path.join(images_dir, name))
+            self.__count(self.dropped, "broken binary")
+            return
+        f.close()
+        self.__binaries.add(fb2_id)
+
+    def __rename_pictures(self):
+        """
+        Fix references to the pictures renamed after their references are written and remove
+        references to the pictures missing in the book.
+        """
+        missing = set(self.missing_pictures())
+        if len(self.__renamed) == 0 and len(missing) == 0:
+            return
+        for filename in (self.CONTENT_FILE, self.NOTES_FILE):
+            out = self.__outputs.pop(filename, None)
+            if out is None:
+                continue
+            out.close()
+            path = os.path.join(self.target_dir, filename)
+            tmp_path = path + ".tmp"
+            src = codecs.open(path, "r", encoding="utf-8")
+            dst = codecs.open(tmp_path, "w", encoding="utf-8")
+            try:
+                skip_empty = False
+                for line in src:
+                    if skip_empty and line == u"\n":
+                        skip_empty = False
+                        continue
+                    skip_empty = False
+                    if line.startswith(u"@img:"):
+                        name = line[5:].rstrip(u"\n")
+                        if name in missing:
+                            skip_empty = True
+                            continue
+                        line = u"@img:%s\n" % self.__renamed.get(name, name)
+                    dst.write(line)
+            finally:
+                src.close()
+                dst.close()
+            os.rename(tmp_path, path)
+
+    def __write_annotation(self):
+        title_info = self.__title_info()
+        if title_info is None:
+            return
+        for ann in children(title_info, "annotation"):
+            self.__out = self.__output(self.ANNOTATION_FILE)
+            self.__write_blocks(ann, ANNOTATION_BLOCKS)
+        for cover in children(title_info, "coverpage"):
+            for image in children(cover, "image"):
+                self.__cover = self.__picture_name(image)
+                break
+
+    def __title_info(self):
+        if self.__description is None:
+            return None
+        for title_info in children(self.__description, "title-info"):
+            return title_info
+        return None
+
+    def __write_project(self):
+        desc = self.__description
+        title_info = self.__title_info()
+        doc_info = publish_info = None
+        if desc is not None:
+            for doc_info in children(desc, "document-info"):
+                break
+            for publish_info in children(desc, "publish-info"):
+                break
+
+        props = [("content-file", self.CONTENT_FILE), ("images-path", self.IMAGES_DIR)]
+        if self.NOTES_FILE in self.__written:
+            props.append(("notes-file", self.NOTES_FILE))
+        if self.ANNOTATION_FILE in self.__written:
+            props.append(("annotation-file", self.ANNOTATION_FILE))
+        props.append(("book-title", child_text(title_info, "book-title") or u""))
+        if title_info is not None:
+            genres = [plain_text(g) for g in children(title_info, "genre")]
+            if len(genres) > 0:
+                props.append(("genres", u",".join(genres)))
+        props.append(("lang", child_text(title_info, "lang")))
+        props.append(("src-lang", child_text(title_info, "src-lang")))
+        props.append(("program-used", child_text(doc_info, "program-used")))
+        if self.__cover is not None and self.__cover not in self.missing_pictures():
+            props.append(("cover-image", self.__renamed.get(self.__cover, self.__cover)))
+        props.append(("date", self.__date(title_info)))
+        props.append(("book-id", child_text(doc_info, "id") or self.__new_book_id()))
+        props.append(("book-version", child_text(doc_info, "version")))
+        props.append(("doc-date", self.__date(doc_info)))
+        props.append(("src-ocr", child_text(doc_info, "src-ocr")))
+        props.append(("book-name", child_text(publish_info, "book-name")))
+        props.append(("publisher", child_text(publish_info, "publisher")))
+        props.append(("publish-city", child_text(publish_info, "city")))
+        props.append(("publish-year", child_text(publish_info, "year")))
+        props.append(("publish-isbn", child_text(publish_info, "isbn")))
+
+        lines = [u"[Project]"]
+        lines.extend(u"%s = %s" % (k, project_value(v)) for k, v in props if v is not None)
+
+        for section, parent, tag in (("Author", title_info, "author"), ("Translator", title_info, "translator"),
+                                     ("DocAuthor", doc_info, "author")):
+            if parent is None:
+                continue
+            for n, a in enumerate(children(parent, tag)):
+                lines.append(u"")
+                lines.append(u"[%s/%d]" % (section, n + 1))
+                for k in ('first-name', 'middle-name', 'last-name', 'nickname', 'home-page', 'email'):
+                    v = child_text(a, k)
+                    if v is not None:
+                        lines.append(u"%s = %s" % (k, project_value(v)))
+
+        if title_info is not None:
+            for n, seq in enumerate(children(title_info, "sequence")):
+                lines.append(u"")
+                lines.append(u"[Sequence/%d]" % (n + 1))
+                lines.append(u"name = %s" % project_value(seq.get("name") or u""))
+                if seq.get("number") is not None:
+                    lines.append(u"number = %s" % project_value(seq.get("number")))
+
+        if doc_info is not None:
+            for history in children(doc_info, "history"):
+                lines.append(u"")
+                lines.append(u"[History]")
+                versions = set()
+                for n, p in enumerate(children(history, "p")):
+                    # compiler writes history items as "version : text"
+                    version, sep, text = plain_text(p).partition(u" : ")
+                    version = re.sub(u"[:=]", u"", version).strip(u" ").lower()
+                    if sep == u"" or version == u"" or version in versions:
+                        version, text = unicode(n + 1), plain_text(p)
+                    versions.add(version)
+                    lines.append(u"%s = %s" % (version, project_value(text)))
+
+        out = codecs.open(os.path.join(self.target_dir, self.PROJECT_FILE), "w", encoding="utf-8")
+        try:
+            out.write(u"\n".join(lines))
+            out.write(u"\n")
+        finally:
+            out.close()
+
+    def __date(self, e):
+        if e is None:
+            return None
+        for d in children(e, "date"):
+            return d.get("value") or plain_text(d)
+        return None
+
+    def __new_book_id(self):
+        # uuid loads ctypes, so it's imported only when it's needed
+        import uuid
+        return unicode(uuid.uuid4())
@@ -0,0 +1,10 @@
+"""
+Exceptions reported to the user, this module has no dependencies so the command line
+script can catch them without importing the heavy modules
+"""
+
+class InvalidProjectError(BaseException):
+    pass
+
+class InvalidMarkupError(BaseException):
+    pass
@@ -0,0 +1,565 @@
+"""
+Picture files handling
+"""
+import os
+import os.path
+import shutil
+import tempfile
+from base64 import encodestring as base64_encode_lines
+from base64 import decodestring as base64_decode_lines
+from cStringIO import StringIO
+from .errors import InvalidMarkupError
+from .cache import make_key
+from .cache import file_digest
+from .xml import make_id
+
+# Pillow is required for pictures optimization only
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# base64 encoder wraps output into 76 chars lines, each line holds 57 bytes of input,
+# so chunk size must be multiple of 57 to keep all lines except last one of equal length
+CHUNK_SIZE = 57 * 1024
+
+CONTENT_TYPES = ((".jpg", "image/jpeg"),
+                 (".png", "image/png"),
+                 (".gif", "image/gif"),
+                 )
+
+def content_type(img):
+    """
+    @return: picture content type detected by the file name
+    """
+    img_name_lo = img.lower()
+    for ext, ct in CONTENT_TYPES:
+        if img_name_lo.endswith(ext):
+            return ct
+
+    raise InvalidMarkupError("Unknown picture `%s' format." % img)
+
+def picture_path(img, images_path):
+    """
+    @return: path to the picture file `img'
+    """
+    img_path = os.path.join(images_path, img)
+    if not os.path.isfile(img_path):
+        raise InvalidMarkupError("Picture file `%s' not found." % img_path)
+
+    return img_path
+
+def iter_base64(filename, chunk_size=CHUNK_SIZE):
+    """
+    Read file by fixed-size chunks and encode each one, so the whole file is never
+    kept in memory.
+
+    @return: iterator over base64 encoded text chunks wrapped into lines
+    """
+    f = open(filename, "rb")
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield base64_encode_lines(chunk)
+    finally:
+        f.close()
+
+def iter_temp_base64(filename):
+    """
+    @return: iterator over base64 encoded text chunks of the temporary file, file is
+             removed at the end
+    """
+    try:
+        for text in iter_base64(filename):
+            yield text
+    finally:
+        os.remove(filename)
+
+def iter_base64_data(data, chunk_size=CHUNK_SIZE):
+    """
+    @return: iterator over base64 encoded text chunks of the string `data'
+    """
+    for i in xrange(0, len(data), chunk_size):
+        yield base64_encode_lines(data[i:i+chunk_size])
+
+def iter_file(f, chunk_size=CHUNK_SIZE):
+    """
+    @return: iterator over file `f' content chunks, file is closed at the end
+    """
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+def write_base64_text(text, f, chunk_size=CHUNK_SIZE):
+    """
+    Decode base64 encoded `text' into file `f' by chunks, so decoded data is never 
+    kept in memory as a whole.
+    """
+    rest = ""
+    for i in xrange(0, len(text), chunk_size):
+        chunk = rest + "".join(text[i:i+chunk_size].split())
+        # only whole 4 characters groups can be decoded separately
+        n = len(chunk) - len(chunk) % 4
+        f.write(base64_decode_lines(chunk[:n]))
+        rest = chunk[n:]
+    if rest != "":
+        raise ValueError("Truncated base64 data")
+
+# optimized pictures format version, must be changed each time optimization changes
+OPTIMIZE_FORMAT = 2
+
+# EXIF Orientation tag
+ORIENTATION_TAG = 0x0112
+# orientation -> transposition turning the picture upright, see ImageOps.exif_transpose()
+ORIENTATION_TRANSPOSE = {2: "FLIP_LEFT_RIGHT", 3: "ROTATE_180", 4: "FLIP_TOP_BOTTOM", 
+                         5: "TRANSPOSE", 6: "ROTATE_270", 7: "TRANSVERSE", 8: "ROTATE_90"}
+
+def apply_orientation(im):
+    """
+    Rotate or mirror JPEG picture `im' as its EXIF Orientation tag says, the tag is not
+    copied into the optimized picture.
+    
+    @return: upright picture
+    """
+    try:
+        exif = im._getexif()
+    except Exception:
+        return im
+    if exif is None or exif.get(ORIENTATION_TAG) not in ORIENTATION_TRANSPOSE:
+        return im
+    return im.transpose(getattr(Image, ORIENTATION_TRANSPOSE[exif[ORIENTATION_TAG]]))
+
+def cpu_count():
+    """
+    @return: number of CPUs or 1 if it's unknown
+    """
+    # imported here, most commands never start worker processes
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class PictureOptimizer:
+    """
+    Lossless recompression of PNG pictures and re-encoding of JPEG pictures, JPEG pictures
+    larger than `max_size' pixels are downscaled. Metadata except color profile is not copied
+    into the result, so JPEG pictures are turned upright by their EXIF orientation before
+    re-encoding. Recompressed picture is used only if it's smaller than the original one.
+    
+    Pictures are optimized on `jobs' worker processes, all CPUs are used by default.
+    """
+
+    def __init__(self, max_size=None, jpeg_quality=85, jobs=None):
+        self.max_size = max_size
+        self.jpeg_quality = jpeg_quality
+        if jobs is None:
+            jobs = cpu_count()
+        self.jobs = jobs
+
+    def key(self):
+        """
+        @return: tuple of values which change the result
+        """
+        return (OPTIMIZE_FORMAT, self.max_size, self.jpeg_quality)
+
+    def optimize(self, img_path):
+        """
+        @return: optimized picture data
+        """
+        f = open(img_path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        try:
+            im = Image.open(StringIO(data))
+            im.load()
+        except Exception:
+            # picture format is not supported by Pillow, keep it as is
+            return data
+
+        params = dict()
+        if "icc_profile" in im.info:
+            params['icc_profile'] = im.info['icc_profile']
+        resized = False
+        try:
+            out = StringIO()
+            if im.format == "PNG":
+                if "transparency" in im.info:
+                    params['transparency'] = im.info['transparency']
+                im.save(out, "PNG", optimize=True, **params)
+            elif im.format == "JPEG":
+                # the original picture keeps its orientation tag if it's used
+                im = apply_orientation(im)
+                if self.max_size is not None and max(im.size) > self.max_size:
+                    im.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+                    resized = True
+                im.save(out, "JPEG", quality=self.jpeg_quality, optimize=True, **params)
+            else:
+                return data
+        except Exception:
+            return data
+
+        result = out.getvalue()
+        if not resized and len(result) >= len(data):
+            return data
+        return result
+
+def optimize_job(job):
+    """
+    Optimize picture in the worker process.
+
+    @param job: tuple (optimizer, img_path)
+    @return: tuple (img_path, data)
+    """
+    optimizer, img_path = job
+    return img_path, optimizer.optimize(img_path)
+
+class PictureIndex:
+    """
+    Maps picture names to ids of the embedded binaries. Pictures are identified by their
+    content, so the same picture saved under different names is embedded once and all
+    its names share the id of the name seen first.
+    """
+
+    def __init__(self, images_path, encoder):
+        self.images_path = images_path
+        self.encoder = encoder
+        # picture name -> binary id
+        self.__ids = dict()
+        # content digest -> binary id
+        self.__digest_ids = dict()
+        # names of pictures to embed, one for each binary, in order of appearance
+        self.pictures = list()
+
+    def picture_id(self, img):
+        """
+        @return: id of the binary with picture `img'
+        """
+        binary_id = self.__ids.get(img)
+        if binary_id is not None:
+            return binary_id
+
+        digest = self.encoder.digest(img, picture_path(img, self.images_path))
+        binary_id = self.__digest_ids.get(digest)
+        if binary_id is None:
+            binary_id = make_id(img)
+            self.__digest_ids[digest] = binary_id
+            self.pictures.append(img)
+        else:
+            # duplicate is never written
+            self.encoder.release(img)
+        self.__ids[img] = binary_id
+        return binary_id
+
+class PictureEncoder:
+    """
+    Produces base64 encoded picture files. When the cache is set, encoded data is stored
+    under the picture content digest and picture file is not read again until it changed.
+    Picture file stat (path, size and mtime) is mapped to the content digest, so unchanged
+    files are not even hashed.
+    
+    When `optimizer' is set, pictures are optimized before encoding, optimized pictures
+    are cached under the original picture digest and optimization parameters.
+    
+    When `prefetch_threads' is greater than 0, compilation reads pictures in advance with
+    PicturePrefetcher on that many threads.
+    """
+
+    def __init__(self, cache=None, optimizer=None, prefetch_threads=0):
+        self.cache = cache
+        self.optimizer = optimizer
+        self.prefetch_threads = prefetch_threads
+        # picture path -> temporary file with optimized data, pictures optimized 
+        # by prepare() when there is no cache
+        self.__optimized = dict()
+        self.__tmp_dir = None
+
+    def __data_key(self, digest):
+        if self.optimizer is None:
+            return make_key("picture-base64", digest)
+        return make_key("picture-base64", digest, *self.optimizer.key())
+
+    def __stat(self, img, img_path):
+        """
+        @return: tuple (digest, content_type) of the picture
+        """
+        st = os.stat(img_path)
+        stat_key = make_key("picture-stat", os.path.abspath(img_path), st.st_size, st.st_mtime)
+        entry = self.cache.get(stat_key)
+        if entry is not None:
+            digest, ct = entry.split(" ")
+        else:
+            digest, ct = file_digest(img_path), content_type(img)
+            self.cache.put(stat_key, "%s %s" % (digest, ct))
+        return digest, ct
+
+    def __chunks(self, img_path):
+        """
+        @return: iterator over base64 encoded text of the picture
+        """
+        if self.optimizer is None:
+            return iter_base64(img_path)
+
+        filename = self.__optimized.pop(img_path, None)
+        if filename is not None:
+            return iter_temp_base64(filename)
+        return iter_base64_data(self.optimizer.optimize(img_path))
+
+    def digest(self, img, img_path):
+        """
+        @return: hex digest of the picture content
+        """
+        if self.cache is None:
+            return file_digest(img_path)
+        return self.__stat(img, img_path)[0]
+
+    def release(self, img):
+        """
+        Forget picture `img' which is not going to be encoded, the encoder keeps nothing 
+        for it, see PicturePrefetcher.release().
+        """
+        pass
+
+    def prepare(self, pictures, jobs=1):
+        """
+        Optimize pictures which are not in the cache on the pool of `jobs' worker processes.
+        Each picture is stored as soon as it's optimized: encoded into its cache entry or 
+        written into a temporary file when there is no cache, so optimized data is not
+        accumulated in memory.
+
+        @param pictures: list of tuples (img, img_path)
+        """
+        if self.optimizer is None:
+            return
+
+        # picture path -> cache key of the encoded picture
+        data_keys = dict()
+        missing = list()
+        for img, img_path in pictures:
+            if self.cache is not None:
+                digest, ct = self.__stat(img, img_path)
+                data_key = self.__data_key(digest)
+                f = self.cache.open(data_key)
+                if f is not None:
+                    f.close()
+                    continue
+                data_keys[img_path] = data_key
+            missing.append((self.optimizer, img_path))
+
+        pool = None
+        if jobs > 1 and len(missing) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(jobs, len(missing)))
+            results = pool.imap_unordered(optimize_job, missing)
+        else:
+            results = (optimize_job(job) for job in missing)
+        try:
+            for img_path, data in results:
+                if self.cache is not None:
+                    self.__store_encoded(data_keys[img_path], data)
+                else:
+                    self.__optimized[img_path] = self.__store_temp(data)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def __store_encoded(self, data_key, data):
+        w = self.cache.writer(data_key)
+        try:
+            for text in iter_base64_data(data):
+                w.write(text)
+        except:
+            w.abort()
+            raise
+        w.commit()
+
+    def __store_temp(self, data):
+        """
+        @return: name of the temporary file with `data'
+        """
+        if self.__tmp_dir is None:
+            self.__tmp_dir = tempfile.mkdtemp(prefix="metafb2-")
+        fd, filename = tempfile.mkstemp(dir=self.__tmp_dir)
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return filename
+
+    def close(self):
+        """
+        Remove temporary files of the optimized pictures which were not encoded.
+        """
+        self.__optimized.clear()
+        if self.__tmp_dir is not None:
+            shutil.rmtree(self.__tmp_dir, ignore_errors=True)
+            self.__tmp_dir = None
+
+    def encode(self, img, img_path):
+        """
+        @return: tuple (content_type, chunks), chunks is iterator over base64 encoded text
+        """
+        if self.cache is None:
+            return content_type(img), self.__chunks(img_path)
+
+        digest, ct = self.__stat(img, img_path)
+        data_key = self.__data_key(digest)
+        f = self.cache.open(data_key)
+        if f is not None:
+            return ct, iter_file(f)
+
+        return ct, self.__encode_to_cache(img_path, data_key)
+
+    def __encode_to_cache(self, img_path, data_key):
+        w = self.cache.writer(data_key)
+        committed = False
+        try:
+            for text in self.__chunks(img_path):
+                w.write(text)
+                yield text
+            w.commit()
+            committed = True
+        finally:
+            if not committed:
+                w.abort()
+
+PREFETCH_THREADS = 4
+# limit of the prefetched encoded text kept in memory, in bytes
+PREFETCH_SIZE = 64 * 1024 * 1024
+
+class PicturePrefetcher:
+    """
+    Reads pictures from `images_path' on the pool of background threads as soon as they are
+    requested, so picture files I/O and encoding overlap with the markup translation. It has
+    digest() and encode() of the PictureEncoder `encoder' and returns prefetched results
+    from them.
+    
+    Digests are prefetched for all pictures, encoded text is prefetched until `max_size' bytes
+    are kept in memory, other pictures are encoded when they are written. Encoded text stops
+    counting to the limit when the picture is encoded or released. Optimized pictures
+    are not encoded in advance, they're optimized by PictureEncoder.prepare(). Failed pictures
+    are processed again when they are used, so errors are raised at the same place as without
+    prefetching.
+    """
+
+    def __init__(self, encoder, images_path, threads=PREFETCH_THREADS, max_size=PREFETCH_SIZE):
+        # imported here, most commands never prefetch pictures
+        import threading
+        from multiprocessing.pool import ThreadPool
+        self.encoder = encoder
+        self.images_path = images_path
+        self.max_size = max_size
+        self.__pool = ThreadPool(threads)
+        self.__lock = threading.Lock()
+        # size of the encoded text reserved by the threads
+        self.__reserved = 0
+        # picture name -> AsyncResult of the prefetch job
+        self.__jobs = dict()
+
+    def request(self, img):
+        """
+        Start reading picture `img' unless it's already requested.
+        """
+        if img not in self.__jobs:
+            self.__jobs[img] = self.__pool.apply_async(self.__prefetch, (img,))
+
+    def __reserve(self, img_path):
+        """
+        @return: reserved size of the encoded picture or 0 if it doesn't fit the memory limit
+        """
+        size = os.path.getsize(img_path) * 4 // 3
+        with self.__lock:
+            if self.__reserved + size > self.max_size:
+                return 0
+            self.__reserved += size
+            return size
+
+    def __unreserve(self, size):
+        with self.__lock:
+            self.__reserved -= size
+
+    def __prefetch(self, img):
+        """
+        @return: tuple (digest, encoded, size) or None on error, encoded is tuple 
+                 (content_type, chunks) or None if picture is not encoded, size is 
+                 reserved size of the encoded text
+        """
+        size = 0
+        try:
+            img_path = picture_path(img, self.images_path)
+            digest = self.encoder.digest(img, img_path)
+            encoded = None
+            if self.encoder.optimizer is None:
+                size = self.__reserve(img_path)
+            if size > 0:
+                ct, chunks = self.encoder.encode(img, img_path)
+                encoded = ct, list(chunks)
+            return digest, encoded, size
+        except (InvalidMarkupError, Exception):
+            # pool threads don't pass BaseException instances
+            if size > 0:
+                self.__unreserve(size)
+            return None
+
+    def __result(self, img):
+        job = self.__jobs.get(img)
+        if job is None:
+            return None
+        return job.get()
+
+    def __pop_result(self, img):
+        """
+        @return: prefetch result of the picture `img', it's forgotten and its encoded text
+                 is no longer counted
+        """
+        job = self.__jobs.pop(img, None)
+        if job is None:
+            return None
+        result = job.get()
+        if result is not None and result[2] > 0:
+            self.__unreserve(result[2])
+        return result
+
+    def digest(self, img, img_path):
+        """
+        @return: hex digest of the picture content
+        """
+        result = self.__result(img)
+        if result is None:
+            return self.encoder.digest(img, img_path)
+        return result[0]
+
+    def encode(self, img, img_path):
+        """
+        @return: tuple (content_type, chunks), chunks is iterator over base64 encoded text
+        """
+        # encoded text is released as soon as it's written
+        result = self.__pop_result(img)
+        if result is None or result[1] is None:
+            return self.encoder.encode(img, img_path)
+        ct, chunks = result[1]
+        return ct, iter(chunks)
+
+    def release(self, img):
+        """
+        Drop prefetched picture `img' which is not going to be encoded, e.g. a picture 
+        with the same content as another one.
+        """
+        self.__pop_result(img)
+
+    def close(self):
+        """
+        Drop pictures which are not read yet and wait for the running threads.
+        """
+        self.__pool.terminate()
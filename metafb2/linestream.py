@@ -1,56 +1,296 @@
 """
 """
+import mmap
+import os
+import re
+from array import array
+from bisect import bisect_right
+from codecs import utf_8_decode
 
-class LineStream:
+STRIP_CHARS = " \r\n\t\x00"
+
+def map_file(filename, copy=False):
+    """
+    When `copy' is set, the file is read into memory instead of mapping: a mapped file
+    truncated in place by another process (e.g. an editor saving it) raises SIGBUS on access.
     
-    def __init__(self, f):
+    @return: read-only memory map of the file (or its content when `copy' is set),
+             empty string if the file is empty
+    """
+    f = open(filename, "rb")
+    try:
+        if copy:
+            return f.read()
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty file can't be mapped
+            return ""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def find_line_starts(data, prefix):
+    """
+    @return: iterator over offsets of the lines of `data' that start with `prefix' 
+             when they are stripped
+    """
+    chars = re.escape(STRIP_CHARS.replace("\n", ""))
+    if re.match("[%s]*%s" % (chars, re.escape(prefix)), data) is not None:
+        yield 0
+    # a literal at the start of the pattern is searched much faster than "^" in the multiline mode
+    for mo in re.finditer("\n[%s]*%s" % (chars, re.escape(prefix)), data):
+        yield mo.start() + 1
+
+class LineStream:
+
+    def __init__(self, f, classify=None):
         """
-        Initialize LineStream object with
+        Initialize LineStream object with lines from `f'. When `classify' function
+        is set, each line is classified once and line classes are available
+        through tag() and peek_tag().
         """
-        self.__lines = list()
-        for line in f:
-            self.__lines.append(line.strip(" \r\n\t\x00"))
-        
-        self.__len = len(self.__lines)
-        self.__pos = -1
-            
+        self._lines = [line.strip(STRIP_CHARS) for line in f]
+
+        self._len = len(self._lines)
+        self._pos = -1
+        # number of moves back
+        self.backtracks = 0
+        self._tags = None
+        if classify is not None:
+            self._tags = [classify(line) for line in self._lines]
+
+    def _has_line(self, n):
+        return n < self._len
+
+    def _line(self, n):
+        return self._lines[n]
+
+    def _tag(self, n):
+        return self._tags[n]
+
     def next(self):
         """
         Read next line
-        
+
         @return: string or None if there is no next item
         """
-        if self.__pos == self.__len-1:
+        if not self._has_line(self._pos+1):
             #return None
             raise StopIteration
-        
-        self.__pos += 1
+
+        self._pos += 1
         return self.cur()
-    
-    #def range(self, begin, end):
-    #    return self.__lines[begin:end]
-    
-    def cur(self):
-        return self.__lines[self.__pos]
+
+    def next_lines(self, tag, skip_tag=None):
+        """
+        Read next lines while they are of the class `tag' or `skip_tag'
         
+        @return: list of the read lines of the class `tag'
+        """
+        tags = self._tags
+        lines = self._lines
+        result = list()
+        n = self._pos + 1
+        while n < self._len:
+            t = tags[n]
+            if t is tag:
+                result.append(lines[n])
+            elif t is not skip_tag:
+                break
+            n += 1
+        self._pos = n - 1
+        return result
+
+    def range(self, begin, end):
+        """
+        @return: list of lines from `begin' up to but not including `end'
+        """
+        return self._lines[begin:end]
+
+    def find_lines(self, prefix):
+        """
+        @return: list of numbers of the lines starting with `prefix'
+        """
+        return [n for n, line in enumerate(self._lines) if line.startswith(prefix)]
+
+    def cur(self):
+        return self._line(self._pos)
+
+    def tag(self):
+        """
+        @return: class of the current line
+        """
+        return self._tag(self._pos)
+
+    def peek(self):
+        """
+        @return: next line without moving internal pointer or None if there is no next line
+        """
+        if not self._has_line(self._pos+1):
+            return None
+
+        return self._line(self._pos+1)
+
+    def peek_tag(self):
+        """
+        @return: class of the next line or None if there is no next line
+        """
+        if not self._has_line(self._pos+1):
+            return None
+
+        return self._tag(self._pos+1)
+
     def go(self, n):
         """
         Move internal pointer to `n' lines, could be relative
         """
-        new_pos = self.__pos + n
-        
+        new_pos = self._pos + n
+        if n < 0:
+            self.backtracks += 1
+
         self.seek(new_pos)
-    
+
     def pos(self):
-        return self.__pos
-    
+        return self._pos
+
     def len(self):
-        return self.__len
-    
+        return self._len
+
     def seek(self, new_pos):
-        if new_pos < -1 or new_pos >= self.__len-1:
+        if new_pos < -1 or not self._has_line(new_pos+1):
             raise Exception
-        
-        self.__pos = new_pos
-        
-        
\ No newline at end of file
+
+        self._pos = new_pos
+
+class MappedLineStream(LineStream):
+    """
+    LineStream over utf-8 encoded file. File is memory-mapped, offsets of lines are
+    found while the stream advances and each line is decoded and stripped only
+    when it is accessed, so opening the stream doesn't depend on the file size.
+    
+    Lines are split on "\n" only ("\r\n" works too as "\r" is stripped), other unicode
+    line breaks (a lone "\r", "\x0b", "\x0c", "\x85", u"\u2028", u"\u2029" and so on)
+    are kept inside the line, unlike file objects opened with codecs.open().
+    """
+
+    def __init__(self, filename, classify=None, copy=False):
+        """
+        @param copy: read the file into memory instead of mapping, see map_file()
+        """
+        self._classify = classify
+        self._map = map_file(filename, copy)
+
+        # offsets[n] is offset of the n-th line, the last item is offset of not yet indexed line
+        self._offsets = array("L", [0])
+        self._indexed = len(self._map) == 0
+        self._pos = -1
+        self.backtracks = 0
+        # the same line is usually read several times in a row
+        self._cached_n = None
+        self._cached_line = None
+
+    def _index_to(self, n):
+        """
+        Find offsets of lines up to the line `n'
+        """
+        while not self._indexed and len(self._offsets) <= n+1:
+            self._index_block()
+
+    def _index_block(self, block_size=64*1024):
+        """
+        Find offsets of lines in the next block of the file
+        """
+        offsets = self._offsets
+        size = len(self._map)
+        start = offsets[-1]
+        block = self._map[start:start+block_size]
+        block_end = start + len(block)
+
+        find = block.find
+        append = offsets.append
+        eol = find("\n")
+        if eol == -1 and block_end < size:
+            # line is longer than block
+            return self._index_block(block_size * 2)
+
+        while eol != -1:
+            append(start + eol + 1)
+            eol = find("\n", eol + 1)
+
+        if block_end == size:
+            if offsets[-1] != size:
+                # last line without line break
+                append(size)
+            self._indexed = True
+
+    def _has_line(self, n):
+        if n < len(self._offsets) - 1:
+            return True
+        self._index_to(n)
+        return n < len(self._offsets) - 1
+
+    def _line(self, n):
+        if n == self._cached_n:
+            return self._cached_line
+
+        if n < 0:
+            n += self.len()
+        offsets = self._offsets
+        if n >= len(offsets) - 1:
+            self._index_to(n)
+        line = utf_8_decode(self._map[offsets[n]:offsets[n+1]], "strict", True)[0].strip(STRIP_CHARS)
+        self._cached_n = n
+        self._cached_line = line
+        return line
+
+    def _tag(self, n):
+        return self._classify(self._line(n))
+
+    def next_lines(self, tag, skip_tag=None):
+        # lines of the file are not kept, so they are read one by one
+        result = list()
+        while True:
+            t = self.peek_tag()
+            if t is None:
+                return result
+            if t is tag:
+                result.append(self.next())
+            elif t is skip_tag:
+                self.next()
+            else:
+                return result
+
+    def range(self, begin, end):
+        if begin >= end:
+            return list()
+        self._index_to(end - 1)
+        offsets = self._offsets
+        data = self._map[offsets[begin]:offsets[end]]
+        lines = utf_8_decode(data, "strict", True)[0].split("\n")
+        if data.endswith("\n"):
+            lines.pop()
+        return [line.strip(STRIP_CHARS) for line in lines]
+
+    def find_lines(self, prefix):
+        # lines are found in the file itself, so the other lines are not decoded
+        self.len()
+        offsets = self._offsets
+        starts = find_line_starts(self._map, prefix.encode("utf-8"))
+        return [bisect_right(offsets, start) - 1 for start in starts]
+
+    def next(self):
+        # the same as LineStream.next() but avoids extra calls on the hot path
+        n = self._pos + 1
+        if n >= len(self._offsets) - 1 and not self._has_line(n):
+            raise StopIteration
+
+        self._pos = n
+        return self._line(n)
+
+    def len(self):
+        while not self._indexed:
+            self._index_block()
+        return len(self._offsets) - 1
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
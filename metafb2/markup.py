@@ -3,20 +3,26 @@ Markup parsing functions.
 """
 from lxml import etree
 from .xml import NSMAP
+from .xml import FB2_NAMESPACE
 from .xml import XLINK_NAMESPACE
-from .xml import TEXT_XML_TEMPLATE
-from .xml import append_element
-from .xml import append_element_cond
 from .xml import make_id
-from . import print_ext
 from .linestream import LineStream
-import codecs
+from .linestream import MappedLineStream
+from .linestream import map_file
+from .linestream import find_line_starts
+from .linestream import STRIP_CHARS
+from .cache import make_key
+from .cache import file_digest
+from .errors import InvalidMarkupError
+from codecs import utf_8_decode
+import cPickle
+import mmap
+import os.path
 import re
 
 
 toHex = lambda x:"".join([hex(ord(c))[2:].zfill(2) for c in x])
 
-class InvalidMarkupError(BaseException):  pass
 class UnexpectedElementError(BaseException):  pass
 
 def fbe(tag, text=None, attrs=None):
@@ -35,77 +41,271 @@ def fbe(tag, text=None, attrs=None):
         
     return node
 
-last_note_num = 1
-notes_map = dict()
+class NullElement:
+    """
+    Element which ignores all changes, it's used instead of xml elements when markup
+    is only checked.
+    """
+    def append(self, e):
+        pass
+
+    def set(self, key, value):
+        pass
+
+NULL_ELEMENT = NullElement()
+
+class CompileContext:
+    """
+    State of a single book compilation, it's passed through all translation functions,
+    so several books can be compiled at the same time.
+    
+    When `check' is set, markup is only checked: no xml is built, and errors of the sections
+    are collected in `errors' instead of stopping the translation.
+    """
+    def __init__(self, stats=None, check=False):
+        # CompileStats object or None when statistics are not collected
+        self.stats = stats
+        self.check = check
+        # messages of the markup errors found in the check mode
+        self.errors = list()
+        # number of the next note reference
+        self.last_note_num = 1
+        # note id -> note reference number
+        self.notes_map = dict()
+        # ids of all note references in order of their numbers
+        self.note_refs = list()
+        # PicturePrefetcher object or None, pictures are requested from it as soon as they're found
+        self.prefetcher = None
+        # source files are read into memory instead of mapping, when they can be changed
+        # during the compilation
+        self.read_copy = False
+
+    def element(self, tag):
+        """
+        @return: new FB2 xml element or NULL_ELEMENT in the check mode
+        """
+        if self.check:
+            return NULL_ELEMENT
+        return fbe(tag)
+
+    def add_note_ref(self, note_id):
+        """
+        Register the next reference to the note `note_id'.
+        
+        @return: number of the reference
+        """
+        num = self.last_note_num
+        self.notes_map[note_id] = num
+        self.note_refs.append(note_id)
+        self.last_note_num += 1
+        return num
 
 REF_RE = re.compile("{{([^}]+?)}}")
 STRONG_RE = re.compile("\*\*(.+?)\*\*")
 EMPHASIS_RE = re.compile("//(.+?)//")
-def pprocess(tag, text):
+# note references and allowed xml tags
+INLINE_RE = re.compile("{{([^}]+?)}}|<(/?su[pb])>")
+
+# Inline markup is resolved on the "shadow" copy of the text where each markup token is replaced 
+# by a single marker character. Markers are control characters that are not allowed in xml text, 
+# and they contain neither "*" nor "/", so STRONG_RE and EMPHASIS_RE match exactly the same 
+# fragments as in the text with real xml tags.
+(M_REF, M_SUP, M_SUP_END, M_SUB, M_SUB_END, 
+ M_STRONG, M_STRONG_END, M_EMPH, M_EMPH_END) = [unichr(x) for x in range(0x0e, 0x17)]
+MARKER_RE = re.compile(u"([\x0e-\x16])")
+INLINE_TAG_MARKERS = {"sup": M_SUP, "/sup": M_SUP_END, "sub": M_SUB, "/sub": M_SUB_END}
+NOTE_REF_TAG = "{%s}a" % FB2_NAMESPACE
+XLINK_HREF = "{%s}href" % XLINK_NAMESPACE
+
+def fb2_tag(tag):
+    return "{%s}%s" % (FB2_NAMESPACE, tag)
+
+# marker -> tag of element opened by the marker
+OPEN_MARKERS = {M_SUP: fb2_tag("sup"), M_SUB: fb2_tag("sub"), 
+                M_STRONG: fb2_tag("strong"), M_EMPH: fb2_tag("emphasis")}
+# marker -> tag of element closed by the marker
+CLOSE_MARKERS = {M_SUP_END: fb2_tag("sup"), M_SUB_END: fb2_tag("sub"), 
+                 M_STRONG_END: fb2_tag("strong"), M_EMPH_END: fb2_tag("emphasis")}
+# opening marker -> closing marker
+CLOSE_MARKERS_BY_OPEN = {M_SUP: M_SUP_END, M_SUB: M_SUB_END, M_STRONG: M_STRONG_END, M_EMPH: M_EMPH_END}
+
+# callables are much faster than template strings in re.sub()
+_strong_markers = lambda mo: M_STRONG + mo.group(1) + M_STRONG_END
+_emphasis_markers = lambda mo: M_EMPH + mo.group(1) + M_EMPH_END
+
+def pprocess(ctx, tag, text):
     """
     Process text and return xml elements for converted text
     """
-    global last_note_num
-    text = text.replace("&", "&#38;").replace("<", "&#60;").replace(">", "&#62;")
+    if ctx.stats is not None:
+        ctx.stats.count("pprocess_calls")
     
-    mo = REF_RE.search(text)
-    while mo is not None:
-        note_id = mo.group(1)
-        text = REF_RE.sub(u'<a l:href="#%s" type="note">[%d]</a>' % 
-                          (make_id(note_id), last_note_num), text, 1)
-        notes_map[note_id] = last_note_num
-        last_note_num += 1
-        mo = REF_RE.search(text)
-    
-    text = REF_RE.sub('<a l:href="#\\1" type="note">[%d]</a>' % last_note_num, text)
-    text = STRONG_RE.sub("<strong>\\1</strong>", text)
-    text = EMPHASIS_RE.sub("<emphasis>\\1</emphasis>", text)
-
-    # perform some "back" replacement
-    text = text.replace("&#60;sup&#62;", "<sup>").replace("&#60;/sup&#62;", "</sup>")\
-        .replace("&#60;sub&#62;", "<sub>").replace("&#60;/sub&#62;", "</sub>")
-    
-    xml = TEXT_XML_TEMPLATE % {
-        'text': text,
-        'tag': tag
-        }
-    try:
-        root = etree.fromstring(xml)
-    except etree.XMLSyntaxError, e:
-        print xml
-        raise
+    if "{{" not in text and "**" not in text and "//" not in text and "<su" not in text and "</su" not in text:
+        # plain text, nothing to convert
+        if ctx.check:
+            return NULL_ELEMENT
+        root = etree.Element(fb2_tag(tag), nsmap=NSMAP)
+        if text != "":
+            root.text = text
+        return root
+    
+    if MARKER_RE.search(text) is not None:
+        raise InvalidMarkupError("Invalid character in the text `%s'" % text)
+    
+    if ctx.check and check_inline(ctx, text):
+        return NULL_ELEMENT
+    
+    # replace note references and tags with markers
+    refs = list()
+    shadow = list()
+    pos = 0
+    for mo in INLINE_RE.finditer(text):
+        shadow.append(text[pos:mo.start()])
+        if mo.group(1) is not None:
+            refs.append(mo.group(1))
+            shadow.append(M_REF)
+        else:
+            shadow.append(INLINE_TAG_MARKERS[mo.group(2)])
+        pos = mo.end()
+    shadow.append(text[pos:])
+    shadow = u"".join(shadow)
+    
+    if "**" in shadow:
+        shadow = STRONG_RE.sub(_strong_markers, shadow)
+    if "//" in shadow:
+        shadow = EMPHASIS_RE.sub(_emphasis_markers, shadow)
+    
+    if ctx.check:
+        check_markers(ctx, text, shadow, refs)
+        return NULL_ELEMENT
+    
+    # build elements, chunks are text pieces interleaved with markers, so each text piece
+    # goes either to the text of the current element or to the tail of the last closed one
+    root = etree.Element(fb2_tag(tag), nsmap=NSMAP)
+    stack = [root]
+    tail_owner = None
+    refs.reverse()
+    for i, chunk in enumerate(MARKER_RE.split(shadow)):
+        if i % 2 == 0:
+            if chunk != "":
+                if tail_owner is None:
+                    stack[-1].text = chunk
+                else:
+                    tail_owner.tail = chunk
+        elif chunk == M_REF:
+            note_id = refs.pop()
+            a = etree.SubElement(stack[-1], NOTE_REF_TAG)
+            a.set(XLINK_HREF, "#%s" % make_id(note_id))
+            a.set("type", "note")
+            a.text = "[%d]" % ctx.add_note_ref(note_id)
+            tail_owner = a
+        elif chunk in OPEN_MARKERS:
+            stack.append(etree.SubElement(stack[-1], OPEN_MARKERS[chunk]))
+            tail_owner = None
+        else:
+            if len(stack) == 1 or stack[-1].tag != CLOSE_MARKERS[chunk]:
+                raise InvalidMarkupError("Improperly nested inline markup in the text `%s'" % text)
+            tail_owner = stack.pop()
+    
+    if len(stack) != 1:
+        raise InvalidMarkupError("Unclosed inline markup in the text `%s'" % text)
     
     return root
 
+def check_inline(ctx, text):
+    """
+    Check inline markup of `text' and register its note references without making the 
+    shadow text. Markup tokens are found in `text' itself: markers of the shadow text 
+    contain neither "*" nor "/", so STRONG_RE and EMPHASIS_RE match the same fragments 
+    in both texts unless a note id contains one of them.
+    
+    @return: False if the text is not checked because of such note id
+    """
+    if "**" not in text and "//" not in text and "<su" not in text and "</su" not in text:
+        # only note references, nothing to nest
+        for mo in REF_RE.finditer(text):
+            ctx.add_note_ref(mo.group(1))
+        return True
+    
+    # tuples (position, marker, note_id) in order of the markers in the shadow text
+    tokens = list()
+    for mo in INLINE_RE.finditer(text):
+        note_id = mo.group(1)
+        if note_id is not None:
+            if "*" in note_id or "/" in note_id:
+                return False
+            tokens.append((mo.start(), M_REF, note_id))
+        else:
+            tokens.append((mo.start(), INLINE_TAG_MARKERS[mo.group(2)], None))
+    if "**" in text:
+        for mo in STRONG_RE.finditer(text):
+            tokens.append((mo.start(), M_STRONG, None))
+            tokens.append((mo.end() - 2, M_STRONG_END, None))
+    if "//" in text:
+        for mo in EMPHASIS_RE.finditer(text):
+            tokens.append((mo.start(), M_EMPH, None))
+            tokens.append((mo.end() - 2, M_EMPH_END, None))
+    tokens.sort()
+    
+    # markers which close the open elements
+    stack = list()
+    for pos, marker, note_id in tokens:
+        if marker == M_REF:
+            ctx.add_note_ref(note_id)
+        elif marker in OPEN_MARKERS:
+            stack.append(CLOSE_MARKERS_BY_OPEN[marker])
+        else:
+            if len(stack) == 0 or stack[-1] != marker:
+                raise InvalidMarkupError("Improperly nested inline markup in the text `%s'" % text)
+            stack.pop()
+    
+    if len(stack) != 0:
+        raise InvalidMarkupError("Unclosed inline markup in the text `%s'" % text)
+    return True
+
+def check_markers(ctx, text, shadow, refs):
+    """
+    Check nesting of the inline markup in the `shadow' text made by pprocess() and register
+    note references `refs' without building elements.
+    """
+    # markers which close the open elements
+    stack = list()
+    refs.reverse()
+    for mo in MARKER_RE.finditer(shadow):
+        marker = mo.group(1)
+        if marker == M_REF:
+            ctx.add_note_ref(refs.pop())
+        elif marker in OPEN_MARKERS:
+            stack.append(CLOSE_MARKERS_BY_OPEN[marker])
+        else:
+            if len(stack) == 0 or stack[-1] != marker:
+                raise InvalidMarkupError("Improperly nested inline markup in the text `%s'" % text)
+            stack.pop()
+    
+    if len(stack) != 0:
+        raise InvalidMarkupError("Unclosed inline markup in the text `%s'" % text)
+
 """
 metafb2 body grammar.
 
 Document MUST start with 1st level SECTION element ("^= ")
 """
 
-def skip_empty_lines(f):
-    """
-    Skip empty lines and comments.
-    """
-    while True:
-        try:
-            line = f.next()
-        except StopIteration:
-            break
-        
-        if line != "" and not line.startswith("#"):
-            f.go(-1)
-            break
-
 class Section:
     def __init__(self):
-        self.lines = list()
+        # own lines of the section are lines [begin, end) of the LineStream `stream', 
+        # they are read only when the section is processed
+        self.stream = None
+        self.begin = 0
+        self.end = 0
         self.subsections = list()
         self.parent = None
         self.sx = None
         self.images = set()
         self.addr = 0 # position of first line of section
         self.id = None
+        # name of the source file or None
+        self.filename = None
         
     def append_section(self, s):
         self.subsections.append(s)
@@ -113,240 +313,218 @@ class Section:
         
     def set_parent(self, parent):
         self.parent = parent
-        
-    def current_offset(self):
-        if not isinstance(self.lines, LineStream):
-            return None
-        
-        return self.addr + self.lines.pos() + 1
+
+    def lines(self):
+        """
+        @return: list of own source lines of the section
+        """
+        if self.stream is None:
+            return list()
+        return self.stream.range(self.begin, self.end)
 
 SECTION_RE = re.compile("^(=+) *(.+)?$")
-def split_into_sections(f):
+def split_into_sections(f, filename=None):
     """
-    Split lines into the sections tree
+    Split lines of the stream `f' into the sections tree, `filename' is the name of the 
+    source file. Sections refer to their lines in `f', so the stream must be kept open
+    until the sections are processed.
     """
     root = Section()
     
     current_section = Section()
+    current_section.stream = f
+    current_section.begin = f.pos() + 1
     current_section_level = 1
     # Do not append to the root!
     # root.append(current_section)
     current_section.set_parent(root)
     
     is_header_block = False
+    # number of the last header line
+    header_n = None
     
-    while True:
-        try:
-            line = f.next()
-        except StopIteration:
-            break
+    # only lines starting with "=" are read, the other lines just end header blocks
+    for n in f.find_lines("="):
+        if n < current_section.begin:
+            continue
+        if n - 1 != header_n:
+            is_header_block = False
+        f.seek(n - 1)
+        mo = SECTION_RE.match(f.next())
+        if mo is None:
+            continue
+        header_n = n
         
-        mo = SECTION_RE.match(line)
-        if mo is not None:
-            # create new section
-            new_section_level = len(mo.group(1))
-            if is_header_block and new_section_level == current_section_level:
-                # do not create new section, just add line to the current
-                current_section.lines.append(line)
-                continue
-            
-            new_section = Section()
-            new_section.lines.append(line)
-            new_section.addr = f.pos()
-            new_section_level = len(mo.group(1))
-            # find position of this section on the tree
-            
-            if new_section_level <= current_section_level:
-                parent = current_section.parent
-                for x in range(0, current_section_level-new_section_level):
-                    parent = parent.parent
-                    
-                # append section after the current section
-                parent.append_section(new_section)
-                is_header_block = True
-            elif new_section_level > current_section_level:
-                if new_section_level > current_section_level+1:
-                    raise InvalidMarkupError("Sections must be directly nested")
-                # new section is a subsection of current_section
-                current_section.append_section(new_section)
-                is_header_block = True
-                
-            current_section = new_section
-            current_section_level = new_section_level
+        # create new section
+        new_section_level = len(mo.group(1))
+        if is_header_block and new_section_level == current_section_level:
+            # do not create new section, the line belongs to the current one
             continue
         
-        is_header_block = False
-        # add line to current section lines list
-        current_section.lines.append(line)
+        current_section.end = n
+        new_section = Section()
+        new_section.stream = f
+        new_section.begin = n
+        new_section.addr = n
+        new_section.filename = filename
+        # find position of this section on the tree
         
+        if new_section_level <= current_section_level:
+            parent = current_section.parent
+            for x in range(0, current_section_level-new_section_level):
+                parent = parent.parent
+                
+            # append section after the current section
+            parent.append_section(new_section)
+            is_header_block = True
+        elif new_section_level > current_section_level:
+            if new_section_level > current_section_level+1:
+                raise InvalidMarkupError("Sections must be directly nested")
+            # new section is a subsection of current_section
+            current_section.append_section(new_section)
+            is_header_block = True
+            
+        current_section = new_section
+        current_section_level = new_section_level
+    
+    current_section.end = f.len()
     return root
 
-def skip_empty_lines(f):
-    """
-    Skip empty lines and comments.
-    """
-    while True:
-        line = f.next()
-        
-        if line != "" and not line.startswith("#"):
-            f.go(-1)
-            break
+# line classes
+L_BLANK = "blank"
+L_COMMENT = "comment"
+L_SECTION = "section"
+L_TEXT = "text"
+L_COMMAND = "command" # unknown command
+L_ID = "id"
+L_EPIGRAPH = "epigraph"
+L_EPIGRAPH_END = "epigraph-end"
+L_ANN = "ann"
+L_ANN_END = "ann-end"
+L_POEM = "poem"
+L_POEM_END = "poem-end"
+L_CITE = "cite"
+L_CITE_END = "cite-end"
+L_IMAGE = "image"
+L_SUBTITLE = "subtitle"
+L_EMPTY_LINE = "empty-line"
 
 ID_RE = re.compile("^@id: *(.+)$")
-def process_id(f):
+EPIGRAPH_BEGIN_RE = re.compile("^@e$")
+EPIGRAPH_END_RE = re.compile("^@e/(.+)?$")
+ANN_BEGIN_RE = re.compile("^@ann$")
+ANN_END_RE = re.compile("^@ann/$")
+POEM_BEGIN_RE = re.compile("^@poem$")
+POEM_END_RE = re.compile("@poem/(.+)?")
+CITE_BEGIN_RE = re.compile("^@cite$")
+CITE_END_RE = re.compile("^@cite/(.+)?")
+IMAGE_RE = re.compile("^@img:(.*)$")
+SUBTITLE_RE = re.compile("^@s:(.*)$")
+
+# commands that take the whole line
+COMMAND_LINES = {"@e": L_EPIGRAPH, "@ann": L_ANN, "@ann/": L_ANN_END, "@poem": L_POEM,
+                 "@cite": L_CITE, "@empty-line": L_EMPTY_LINE}
+# commands with arguments, (prefix, line class)
+COMMAND_PREFIXES = (("@img:", L_IMAGE), ("@s:", L_SUBTITLE), ("@e/", L_EPIGRAPH_END),
+                    ("@cite/", L_CITE_END), ("@poem/", L_POEM_END))
+
+def classify_line(line):
     """
-    @return: id value or None if there is no one
+    @return: line class, one of L_* constants
     """
-    line = f.next()
-
-    mo = ID_RE.match(line)
-    if mo is None:
-        f.go(-1)
-        return None
+    if line == "":
+        return L_BLANK
+    
+    c = line[0]
+    if c != "@":
+        if c == "#":
+            return L_COMMENT
+        if c == "=":
+            return L_SECTION
+        return L_TEXT
+    
+    tag = COMMAND_LINES.get(line)
+    if tag is not None:
+        return tag
+    for prefix, tag in COMMAND_PREFIXES:
+        if line.startswith(prefix):
+            return tag
+    if ID_RE.match(line) is not None:
+        return L_ID
     
-    return mo.group(1)
+    return L_COMMAND
 
-def process_para(f):
+def peek_block(f):
     """
-    Process paragraph element
+    Skip empty lines and comments.
     
-    @return: paragraph xml element or None
+    @return: class of the first line of the next block or None if there are no more lines
     """
-    skip_empty_lines(f)
-    pos = f.pos()
-    text_lines = list()
-    
     while True:
-        try:
-            line = f.next()
-        except StopIteration:
-            break
-        
-        if line.startswith("#"):
-            continue
-        
-        if line == "" or line.startswith("@") or line.startswith("="):
-            f.go(-1)
-            # finish block
-            break
-        
-        text_lines.append(line)
-        
-    if len(text_lines) == 0:
-        return None
-    
-    return pprocess("p", " ".join(text_lines))
+        tag = f.peek_tag()
+        if tag is not L_BLANK and tag is not L_COMMENT:
+            return tag
+        f.next()
 
-EPIGRAPH_BEGIN_RE = re.compile("^@e$")
-EPIGRAPH_END_RE = re.compile("^@e/(.+)?$")
-def process_epigraph(f):
-    """
-    @return: xml element <epigraph> or None if there is no such element
+"""
+Block processing functions. Each function is called when the next line of the stream
+starts the block of its type, reads the whole block and returns xml element.
+"""
+
+def process_para(ctx, f, images):
     """
-    skip_empty_lines(f)
-    pos = f.pos()
-    line = f.next()
-    mo = EPIGRAPH_BEGIN_RE.match(line)
-    if mo is None:
-        f.seek(pos)
-        return None
-    
-    epigraph = fbe("epigraph")
-    
-    block_end_reached = False
-    try:
-        while True:
-            line = f.next()
-            mo = EPIGRAPH_END_RE.match(line)
-            if mo is not None:
-                block_end_reached = True
-                if mo.group(1) is not None:
-                    epigraph.append(pprocess("text-author", mo.group(1)))
-                break
-            else:
-                f.go(-1)
-            
-            
-            # empty line
-            el = process_empty_line(f)
-            if el is not None:
-                epigraph.append(el)
-            # p - paragraph, must stand at the bottom of list
-            p = process_para(f)
-            if p is not None:
-                epigraph.append(p)
-            
-    except StopIteration:
-        pass
+    Process paragraph element
     
-    if not block_end_reached:
-        raise InvalidMarkupError("Epigraph block not closed.")
+    @return: paragraph xml element
+    """
+    text_lines = f.next_lines(L_TEXT, L_COMMENT)
     
-    return epigraph
+    if ctx.stats is not None:
+        ctx.stats.count("paragraphs")
+    return pprocess(ctx, "p", " ".join(text_lines))
 
-ANN_BEGIN_RE = re.compile("^@ann$")
-ANN_END_RE = re.compile("^@ann/$")
-def process_ann(f):
-    skip_empty_lines(f)
-    line = f.next()
-    mo = ANN_BEGIN_RE.search(line)
-    if mo is None:
-        f.go(-1)
-        return None
-    
-    ann = fbe("annotation")
+def process_image(ctx, f, images):
+    """
+    Process image element, image name is added to the `images' set.
     
-    block_end_reached = False
-    try:
-        while True:
-            line = f.next()
-            mo = ANN_END_RE.match(line)
-            if mo is not None:
-                block_end_reached = True
-                break
-            else:
-                f.go(-1)
-
-            # cite
-            cite = process_cite(f)
-            if cite is not None:
-                ann.append(cite)
-
-            # subtitle
-            subtitle = process_subtitle(f)
-            if subtitle is not None:
-                ann.append(subtitle)
-
-            # empty line
-            el = process_empty_line(f)
-            if el is not None:
-                ann.append(el)
-            # p - paragraph, must stand at the bottom of list
-            p = process_para(f)
-            if p is not None:
-                ann.append(p)
-            
-    except StopIteration:
-        pass
+    @return: image xml element
+    """
+    mo = IMAGE_RE.match(f.next())
+    image_name = mo.group(1)
 
-    if not block_end_reached:
-        raise InvalidMarkupError("Annotation block not closed.")
+    if image_name == "":
+        raise InvalidMarkupError("Missing image name")
     
-    return ann
+    image = ctx.element("image")
+    image.set("{%s}href" % XLINK_NAMESPACE, "#%s" % make_id(image_name))
+    images.add(image_name)
+    if ctx.prefetcher is not None:
+        ctx.prefetcher.request(image_name)
     
-POEM_BEGIN_RE = re.compile("^@poem$")
-POEM_END_RE = re.compile("@poem/(.+)?")
-def process_poem(f):
-    skip_empty_lines(f)
-    pos = f.pos()
-    line = f.next()
-    mo = POEM_BEGIN_RE.search(line)
-    if mo is None:
-        f.go(-1)
-        return None
+    return image
+
+def process_subtitle(ctx, f, images):
+    """
+    @return: subtitle xml element
+    """
+    mo = SUBTITLE_RE.match(f.next())
+    text = mo.group(1)
+    if text == "":
+        raise InvalidMarkupError("Missing subtitle text")
     
-    poem = fbe("poem")
-    current_stanza = fbe("stanza")
+    return pprocess(ctx, "subtitle", text)
+
+def process_empty_line(ctx, f, images):
+    """
+    @return: empty line xml element
+    """
+    f.next()
+    return ctx.element("empty-line")
+
+def process_poem(ctx, f, images):
+    f.next()
+    poem = ctx.element("poem")
+    current_stanza = ctx.element("stanza")
     poem.append(current_stanza)
     
     block_end_reached = False
@@ -357,16 +535,16 @@ def process_poem(f):
             if mo is not None:
                 block_end_reached = True
                 if mo.group(1) is not None:
-                    poem.append(pprocess("text-author", mo.group(1)))
+                    poem.append(pprocess(ctx, "text-author", mo.group(1)))
                 break
             
             if line == "":
                 # close stanza and create stanza
-                current_stanza = fbe("stanza")
+                current_stanza = ctx.element("stanza")
                 poem.append(current_stanza)
                 continue
             
-            current_stanza.append(pprocess("v", line))
+            current_stanza.append(pprocess(ctx, "v", line))
             
     except StopIteration:
         pass
@@ -376,398 +554,731 @@ def process_poem(f):
     
     return poem
 
-CITE_BEGIN_RE = re.compile("^@cite$")
-CITE_END_RE = re.compile("^@cite/(.+)?")
-def process_cite(f):
-    skip_empty_lines(f)
-    pos = f.pos()
-    line = f.next()
-    mo = CITE_BEGIN_RE.match(line)
-    if mo is None:
-        f.go(-1)
-        return None
-    
-    cite = fbe("cite")
+def unknown_command_error(f):
+    """
+    @return: error for the unexpected next line
+    """
+    e = InvalidMarkupError("Unknown command `%s'" % f.peek())
+    # the error is about the next line, not the current one
+    e.pos = f.pos() + 1
+    return e
 
-    # now find inner citation elements: p, subtitle, empty-line
-    block_end_reached = False
-    
-    try:
-        while True:
-            line = f.next()
-            mo = CITE_END_RE.match(line)
-            if mo is not None:
-                block_end_reached = True
-                text_author = mo.group(1)
-                if text_author is not None:
-                    cite.append(pprocess("text-author", text_author))
-                break
-            else:
-                f.go(-1)
+def located_error(e, filename, line):
+    """
+    @return: error `e' with the file name and the line number in the message, 
+             errors which already have them are returned as is
+    """
+    if getattr(e, "located", False):
+        return e
+    if filename is None:
+        located = InvalidMarkupError("Line %d: %s" % (line, e.message))
+    else:
+        located = InvalidMarkupError("File `%s', line %d: %s" % (filename, line, e.message))
+    located.located = True
+    return located
 
-            # subtitle
-            subtitle = process_subtitle(f)
-            if subtitle is not None:
-                cite.append(subtitle)
-                continue
-            # empty line
-            el = process_empty_line(f)
-            if el is not None:
-                cite.append(el)
-                continue
-            # p - paragraph, must stand at the bottom of list
-            para = process_para(f)
-            if para is not None:
-                cite.append(para)
-    except StopIteration:
-        pass
+def stream_error(e, f, filename, addr=0):
+    """
+    @return: error `e' raised while reading the stream `f' located at the line being read, 
+             `addr' is position of the first line of the stream in the file
+    """
+    pos = getattr(e, "pos", None)
+    if pos is None:
+        pos = max(f.pos(), 0)
+    return located_error(e, filename, addr + pos + 1)
 
-    if not block_end_reached:
-        raise InvalidMarkupError("Cite block not closed.")
+def process_blocks(ctx, f, e, blocks, images, end_tag=None, block_name=None):
+    """
+    Process blocks of the types from the `blocks' dispatch table (line class -> block 
+    processing function) and append their elements to `e'. Stops at the end of stream or, 
+    if `end_tag' is set, at the line of this class.
     
-    return cite
+    @return: block end line or None
+    """
+    while True:
+        tag = peek_block(f)
+        if tag is None:
+            if end_tag is not None:
+                raise InvalidMarkupError("%s block not closed." % block_name)
+            return None
+        
+        if tag is end_tag:
+            return f.next()
+        
+        process = blocks.get(tag)
+        if process is None:
+            raise unknown_command_error(f)
+        e.append(process(ctx, f, images))
 
-IMAGE_RE = re.compile("^@img:(.*)$")
-def process_image(f):
+def process_epigraph(ctx, f, images):
     """
-    @return: tuple (image, image_name), where image is xml element, image_name is an image name.
+    @return: xml element <epigraph>
     """
-    skip_empty_lines(f)
-    line = f.next()
-    mo = IMAGE_RE.match(line)
-    if mo is None:
-        f.go(-1)
-        return None, None
+    f.next()
+    epigraph = ctx.element("epigraph")
+    line = process_blocks(ctx, f, epigraph, EPIGRAPH_BLOCKS, images, L_EPIGRAPH_END, "Epigraph")
     
-    image_name = mo.group(1)
+    text_author = EPIGRAPH_END_RE.match(line).group(1)
+    if text_author is not None:
+        epigraph.append(pprocess(ctx, "text-author", text_author))
+    
+    return epigraph
 
-    if image_name == "":
-        raise InvalidMarkupError("Missing image name on line %d" % (f.pos()+1))
+def process_ann(ctx, f, images):
+    f.next()
+    ann = ctx.element("annotation")
+    process_blocks(ctx, f, ann, ANN_BLOCKS, images, L_ANN_END, "Annotation")
+    
+    return ann
+
+def process_cite(ctx, f, images):
+    f.next()
+    cite = ctx.element("cite")
+    # now find inner citation elements: p, subtitle, empty-line
+    line = process_blocks(ctx, f, cite, CITE_BLOCKS, images, L_CITE_END, "Cite")
     
-    img_id = make_id(image_name)
-    image = fbe("image")
-    image.set("{%s}href" % XLINK_NAMESPACE, "#%s" % img_id)
+    text_author = CITE_END_RE.match(line).group(1)
+    if text_author is not None:
+        cite.append(pprocess(ctx, "text-author", text_author))
     
-    return image, image_name
+    return cite
 
-SUBTITLE_RE = re.compile("^@s:(.*)$")
-def process_subtitle(f):
+# block dispatch tables: line class -> block processing function
+EPIGRAPH_BLOCKS = {L_EMPTY_LINE: process_empty_line, L_TEXT: process_para}
+ANN_BLOCKS = {L_CITE: process_cite, L_SUBTITLE: process_subtitle,
+              L_EMPTY_LINE: process_empty_line, L_TEXT: process_para}
+CITE_BLOCKS = {L_SUBTITLE: process_subtitle, L_EMPTY_LINE: process_empty_line, L_TEXT: process_para}
+# inner section elements: p, image, subtitle, cite, poem, empty-line
+SECTION_BLOCKS = {L_IMAGE: process_image, L_SUBTITLE: process_subtitle, L_CITE: process_cite,
+                  L_POEM: process_poem, L_EMPTY_LINE: process_empty_line, L_TEXT: process_para}
+ANNOTATION_BLOCKS = {L_SUBTITLE: process_subtitle, L_CITE: process_cite, L_POEM: process_poem,
+                     L_EMPTY_LINE: process_empty_line, L_TEXT: process_para}
+
+# line class of the block start -> line class of the block end
+BLOCK_ENDS = {L_EPIGRAPH: L_EPIGRAPH_END, L_ANN: L_ANN_END, L_CITE: L_CITE_END, L_POEM: L_POEM_END}
+
+def skip_block(f, start_tag):
     """
-    @return: subtitle xml element
+    Skip the rest of the block which starts with the line of class `start_tag' after 
+    an error inside it.
     """
-    skip_empty_lines(f)
-    line = f.next()
-    mo = SUBTITLE_RE.match(line)
-    if mo is None:
-        f.go(-1)
-        return None
-    
-    text = mo.group(1)
-    if text == "":
-        raise InvalidMarkupError("Missing subtitle text on line %d" % (f.pos()+1))
-    
-    subtitle = pprocess("subtitle", text)
-    return subtitle
+    end_tag = BLOCK_ENDS.get(start_tag)
+    if end_tag is None or f.tag() is end_tag:
+        # the block is already read
+        return
+    while True:
+        tag = f.peek_tag()
+        if tag is None:
+            return
+        f.next()
+        if tag is end_tag:
+            return
 
-def process_empty_line(f):
+def process_block(ctx, section, f, process):
     """
-    @return: empty line xml element
+    Process the next block of the section with the block processing function `process'.
+    In the check mode an error of the block is recorded and the rest of the block is
+    skipped, so the following blocks are checked too.
+    
+    @return: xml element of the block
     """
-    skip_empty_lines(f)
-    line = f.next()
-    if line != "@empty-line":
-        f.go(-1)
-        return None
+    if not ctx.check:
+        return process(ctx, f, section.images)
     
-    return fbe("empty-line")
+    start_tag = f.peek_tag()
+    try:
+        return process(ctx, f, section.images)
+    except InvalidMarkupError, e:
+        ctx.errors.append(stream_error(e, f, section.filename, section.addr).message)
+        skip_block(f, start_tag)
+        return NULL_ELEMENT
 
-def process_section(section):
+def process_section(ctx, section):
+    
+    f = LineStream(section.lines(), classify_line)
+    try:
+        process_section_blocks(ctx, section, f)
+    except InvalidMarkupError, e:
+        e = stream_error(e, f, section.filename, section.addr)
+        if not ctx.check:
+            raise e
+        # the rest of the section is skipped, its subsections are checked
+        ctx.errors.append(e.message)
+    
+    if ctx.stats is not None:
+        ctx.stats.count("sections")
+        ctx.stats.count("backtracks", f.backtracks)
     
-    section.lines = LineStream(section.lines)
-    section.sx = fbe("section")
+    for subsection in section.subsections:
+        process_section(ctx, subsection)
+
+def process_section_blocks(ctx, section, f):
+    """
+    Build xml element of the section `section' from its own lines from the stream `f'
+    """
+    section.sx = ctx.element("section")
 
     # find section title
     title_items = list()
-    while True:
-        try:
-            line = section.lines.next()
-        except StopIteration:
-            break
-        
-        mo = SECTION_RE.match(line)
-        if mo is None:
-            section.lines.go(-1)
-            break
-        
+    while f.peek_tag() is L_SECTION:
+        mo = SECTION_RE.match(f.next())
         if mo.group(2) is not None:
             title_items.append(mo.group(2))
     
     if len(title_items) > 0:
-        title = fbe("title")
+        title = ctx.element("title")
         section.sx_title = title
         section.sx.append(title)
         for t in title_items:
-            title.append(pprocess("p", t))
-    try:
-        # find ID element
-        id = process_id(section.lines)
-        if id is not None:
-            section.sx.set("id", make_id(id))
-            
-        # discover all epigraphs
-        while True:
-            epigraph = process_epigraph(section.lines)
-            if epigraph is None:
-                break
-            section.sx.append(epigraph)
+            if ctx.check:
+                try:
+                    pprocess(ctx, "p", t)
+                except InvalidMarkupError, e:
+                    ctx.errors.append(stream_error(e, f, section.filename, section.addr).message)
+                continue
+            title.append(pprocess(ctx, "p", t))
+    
+    # find ID element, it must follow the title
+    if f.peek_tag() is L_ID:
+        id = ID_RE.match(f.next()).group(1)
+        section.sx.set("id", make_id(id))
         
-        # discover ann
-        ann = process_ann(section.lines)
-        if ann is not None:
-            section.sx.append(ann)
+    # discover all epigraphs
+    while peek_block(f) is L_EPIGRAPH:
+        section.sx.append(process_block(ctx, section, f, process_epigraph))
+    
+    # discover ann
+    if peek_block(f) is L_ANN:
+        section.sx.append(process_block(ctx, section, f, process_ann))
+    
+    # discover image
+    if peek_block(f) is L_IMAGE:
+        section.sx.append(process_block(ctx, section, f, process_image))
         
-        # discover image
-        image, image_name = process_image(section.lines)
-        if image is not None:
-            section.sx.append(image)
-            section.images.add(image_name)
-            
-        if len(section.subsections) > 0:
-            def assert_forbidden():
-                raise InvalidMarkupError("Section has subsections so inner elements are not allowed.")
-        else:
-            def assert_forbidden(): pass
-            
-        # now find inner section elements: p, image, subtitle, cite, empty-line
-        while True:
-            # image
-            image, image_name = process_image(section.lines)
-            if image is not None:
-                assert_forbidden()
-                section.sx.append(image)
-                section.images.add(image_name)
-                continue
-            # subtitle
-            subtitle = process_subtitle(section.lines)
-            if subtitle is not None:
-                assert_forbidden()
-                section.sx.append(subtitle)
-                continue
-            # cite
-            cite = process_cite(section.lines)
-            if cite is not None:
-                assert_forbidden()
-                section.sx.append(cite)
-                continue
-            # poem
-            poem = process_poem(section.lines)
-            if poem is not None:
-                assert_forbidden()
-                section.sx.append(poem)
-                continue
-            # empty line
-            el = process_empty_line(section.lines)
-            if el is not None:
-                assert_forbidden()
-                section.sx.append(el)
-                continue
-                
+    # now find inner section elements
+    while True:
+        tag = peek_block(f)
+        if tag is None:
+            break
+        
+        process = SECTION_BLOCKS.get(tag)
+        if process is None:
             # now we don't expect any other commands (lines that start with "@")
-            skip_empty_lines(section.lines)
-            line = section.lines.next()
-            section.lines.go(-1)
-            if line.startswith("@"):
-                raise InvalidMarkupError("Unknown command on line %s `%s'" % (section.current_offset(), line))
+            e = unknown_command_error(f)
+            if not ctx.check:
+                raise e
+            # the line is skipped
+            ctx.errors.append(stream_error(e, f, section.filename, section.addr).message)
+            f.next()
+            continue
+        
+        e = process_block(ctx, section, f, process)
+        if len(section.subsections) > 0:
+            raise InvalidMarkupError("Section has subsections so inner elements are not allowed.")
+        section.sx.append(e)
             
-            # p - paragraph, must stand at the bottom of list
-            para = process_para(section.lines)
-            if para is not None:
-                assert_forbidden()
-                section.sx.append(para)
-                
-            #print section.addr+section.lines.pos() # addr of the section, relative position inside the section
-    except StopIteration:
-        pass
+def collect_images(s, images=None):
+    """
+    @return: set of images names used in the section `s' and all its subsections
+    """
+    if images is None:
+        images = set()
+    images.update(s.images)
     
-    # find other section elements
-    #etree.dump(section.sx)
-    # process section.lines
-    # detect section title elements
+    for subs in s.subsections:
+        collect_images(subs, images)
     
-    for subsection in section.subsections:
-        process_section(subsection)
-            
-def translate_body(filename):
+    return images
+
+def assemble_section(s):
     """
-    return tuple (body, images_list, notes_map)
+    Append xml elements of subsections to the section xml element
     """
-    global notes_map
-    body = etree.Element("body", nsmap=NSMAP)
-    images = set()
-    notes_map = dict()
+    for x in s.subsections:
+        s.sx.append(x.sx)
+        assemble_section(x)
+
+def section_lines(s):
+    """
+    @return: list of source lines of the section `s' and all its subsections
+    """
+    lines = s.lines()
+    for subs in s.subsections:
+        lines.extend(section_lines(subs))
     
-    cf = codecs.open(filename, mode="r", encoding="utf-8")
-    f = LineStream(cf)
-    cf.close()
+    return lines
+
+# cached section fragments format version, must be changed each time generated xml 
+# or cache entries layout changes
+FRAGMENT_FORMAT = 3
+
+def fragment_key(s):
+    """
+    @return: cache key of the top level section `s' fragment
+    """
+    return make_key("section-fragment", FRAGMENT_FORMAT, *section_lines(s))
+
+def parsed_file_key(cache, kind, filename):
+    """
+    @return: cache key of the translated file `filename' of the type `kind'. Digest of the 
+             file content is kept in the cache by the file path, size and mtime, so unchanged 
+             files are not read.
+    """
+    path = os.path.abspath(filename)
+    st = os.stat(filename)
+    stat_key = make_key("parsed-file-stat", path, st.st_size, st.st_mtime)
+    digest = cache.get(stat_key)
+    if digest is None:
+        digest = file_digest(filename)
+        cache.put(stat_key, digest)
+    return make_key("parsed-file", kind, FRAGMENT_FORMAT, path, digest)
+
+def dump_entry(value):
+    return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+def make_fragment(ctx, s, first_ref):
+    """
+    Make section fragment from the processed section `s'. Fragment is a picklable tuple 
+    (xml, refs, images): serialized section xml, list of ids of note references in order 
+    of their appearance and list of images names.
+    """
+    return (etree.tostring(s.sx, encoding="utf-8"), ctx.note_refs[first_ref:], list(collect_images(s)))
+
+def load_fragment(ctx, fragment):
+    """
+    Load section xml fragment and renumber its note references
+    so they continue current notes numbering.
     
-    if f.len() > 0:
-        line = f.next()
-        f.go(-1)
-        if not line.startswith("="):
-            raise InvalidMarkupError("First line must specify 1st level section, file `%s'" % filename)
+    @return: tuple (section_xml, images) or None if fragment doesn't match its references list
+    """
+    xml, refs, images = fragment
+    sx = etree.fromstring(xml)
+    anchors = [a for a in sx.iter(NOTE_REF_TAG) if a.get("type") == "note"]
+    if len(anchors) != len(refs):
+        return None
     
-    #1. split text into sections
-    root = split_into_sections(f)
-    #2. process each section separately
-    process_section(root)
-    #3. find all images
+    for a, note_id in zip(anchors, refs):
+        a.text = "[%d]" % ctx.add_note_ref(note_id)
     
-    def _walk_images(s, im):
-        [im.add(x) for x in s.images]
-        
+    if ctx.prefetcher is not None:
+        for img in images:
+            ctx.prefetcher.request(img)
+    return sx, set(images)
+
+def translate_section_job(job):
+    """
+    Translate top level section in the worker process.
+    
+    @param job: tuple (lines, addr, filename), section source lines, position of its first line
+                and name of the source file
+    @return: tuple (fragment, error_message)
+    """
+    lines, addr, filename = job
+    ctx = CompileContext()
+    
+    def _shift_addr(s):
+        s.addr += addr
         for subs in s.subsections:
-            _walk_images(subs, im)
+            _shift_addr(subs)
+    
+    try:
+        s = split_into_sections(LineStream(lines), filename).subsections[0]
+        _shift_addr(s)
+        process_section(ctx, s)
+        assemble_section(s)
+    except InvalidMarkupError, e:
+        # pool workers don't pass BaseException instances to the parent process
+        return None, e.message
     
-    # collect images
-    _walk_images(root, images)
+    return make_fragment(ctx, s, 0), None
 
-    def _walk_sections(s):
-        for x in s.subsections:
-            s.sx.append(x.sx)
-            _walk_sections(x)
-            
-    _walk_sections(root)
+def translate_sections_parallel(sections, jobs):
+    """
+    Translate top level sections on the pool of `jobs' worker processes.
     
-    for x in root.subsections:
-        body.append(x.sx)
-        
-    #etree.dump(body)
-        
-    # build xml tree
+    @return: list of fragments in the same order
+    """
+    # imported here, most compilations are done without worker processes
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(translate_section_job, [(section_lines(s), s.addr, s.filename) for s in sections])
+    finally:
+        pool.terminate()
     
-    #_pp(root, 0)
+    fragments = list()
+    for fragment, error in results:
+        if error is not None:
+            raise InvalidMarkupError(error)
+        fragments.append(fragment)
     
-    return body, images, notes_map
+    return fragments
 
-def translate_annotation(filename):
-    cf = codecs.open(filename, mode="r", encoding="utf-8")
-    f = LineStream(cf)
-    cf.close()
-    ann = etree.Element("annotation", nsmap=NSMAP)
-    
+def split_content_file(ctx, filename):
+    """
+    @return: list of top level sections of the content file
+    """
+    f = MappedLineStream(filename, copy=ctx.read_copy)
     try:
-        while True:
-            # subtitle
-            subtitle = process_subtitle(f)
-            if subtitle is not None:
-                ann.append(subtitle)
-                continue
-            # cite
-            cite = process_cite(f)
-            if cite is not None:
-                ann.append(cite)
-                continue
-            # poem
-            poem = process_poem(f)
-            if poem is not None:
-                ann.append(poem)
-                continue
-            # empty line
-            el = process_empty_line(f)
-            if el is not None:
-                ann.append(el)
-                continue
-                
-            # now we don't expect any other commands (lines that start with "@")
-            skip_empty_lines(f)
+        try:
             line = f.next()
             f.go(-1)
-            if line.startswith("@"):
-                raise InvalidMarkupError("UNknown command on line %s `%s'" % (f.pos()+1, line))
-            
-            # p - paragraph, must stand at the bottom of list
-            para = process_para(f)
-            if para is not None:
-                ann.append(para)
-    except StopIteration:
-        pass
+        except StopIteration:
+            line = None
+        if line is not None and not line.startswith("="):
+            raise InvalidMarkupError("First line must specify 1st level section, file `%s'" % filename)
+        
+        try:
+            root = split_into_sections(f, filename)
+        except InvalidMarkupError, e:
+            raise stream_error(e, f, filename)
+    except Exception:
+        f.close()
+        raise
+    # sections read their lines from the mapped file, it's unmapped when they are released
+    if ctx.stats is not None:
+        ctx.stats.count("backtracks", f.backtracks)
+    return root.subsections
+
+def translate_body(ctx, filenames, cache=None, jobs=1):
+    """
+    Translate content files into a single <body> element, see translate_body_sections().
     
-    return ann
+    return tuple (body, images_list, notes_map)
+    """
+    body = etree.Element("body", nsmap=NSMAP)
+    images = set()
+    for sx, section_images in translate_body_sections(ctx, filenames, cache, jobs):
+        body.append(sx)
+        images.update(section_images)
+    return body, images, ctx.notes_map
 
-def split_notes_into_sections(f):
+def translate_body_sections(ctx, filenames, cache=None, jobs=1):
     """
-    @return: Section() object with all sections
+    Translate content files, their sections are joined in order of `filenames' and notes are 
+    numbered through all files. When `cache' is set unchanged files and top level sections
+    are taken from the cache instead of processing, when `jobs' is greater than 1
+    top level sections are processed on the pool of worker processes.
+    
+    Top level sections are generated one by one in document order, so the caller can write
+    each section out before the next one is translated.
+    
+    @return: iterator over tuples (section_element, images_list)
     """
-    root = Section()
+    #1. take unchanged files from the cache, split other files into sections
+    # for each file: cache key, list of top level sections fragments, list of sections 
+    # or None when the file is not split and list of sections cache keys
+    file_keys = list()
+    file_fragments = list()
+    file_sections = list()
+    file_section_keys = list()
+    for filename in filenames:
+        key = fragments = sections = section_keys = None
+        if cache is not None:
+            key = parsed_file_key(cache, "content", filename)
+            entry = cache.get(key)
+            if entry is not None:
+                section_keys, fragments = cPickle.loads(entry)
+                # sections entries are kept for the next change of the file
+                for section_key in section_keys:
+                    cache.touch(section_key)
+                if ctx.stats is not None:
+                    ctx.stats.count("cached_files")
+        if fragments is None:
+            sections = split_content_file(ctx, filename)
+            fragments = [None] * len(sections)
+        file_keys.append(key)
+        file_fragments.append(fragments)
+        file_sections.append(sections)
+        file_section_keys.append(section_keys)
     
-    #raw_sections = list()
-    current_section = Section()
-    current_section.set_parent(root)
-    # do not append current_section !!! 
+    #2. find already translated sections
+    if cache is not None:
+        for fi, sections in enumerate(file_sections):
+            if sections is None:
+                continue
+            file_section_keys[fi] = [fragment_key(s) for s in sections]
+            for i, section_key in enumerate(file_section_keys[fi]):
+                entry = cache.get(section_key)
+                if entry is not None:
+                    file_fragments[fi][i] = cPickle.loads(entry)
     
-    try:
-        while True:
-            line = f.next()
-            
-            mo = SECTION_RE.match(line)
-            if mo is not None:
-                # start new section
-                section_level = len(mo.group(1))
-                
-                if section_level != 1:
-                    raise InvalidMarkupError("In the notes file only first level sections allowed. Level: %s." % section_level)
-                
-                new_section = Section()
-                new_section.addr = f.pos()
-                root.append_section(new_section)
-                current_section = new_section
-                
-                # find section id, element "@id" must follow section header
-                mo = ID_RE.match(f.next())
-                f.go(-1)
-                if mo is None:
-                    raise InvalidMarkupError("@id element is required for each section in the notes file!")
-                current_section.id = mo.group(1)
+    #3. translate other sections on the workers pool
+    if jobs > 1:
+        missing = [(fi, i) for fi, sections in enumerate(file_sections) if sections is not None
+                   for i in range(len(sections)) if file_fragments[fi][i] is None]
+        if len(missing) > 1:
+            parallel_fragments = translate_sections_parallel([file_sections[fi][i] for fi, i in missing], jobs)
+            for (fi, i), fragment in zip(missing, parallel_fragments):
+                file_fragments[fi][i] = fragment
+                if cache is not None:
+                    cache.put(file_section_keys[fi][i], dump_entry(fragment))
+    
+    #4. merge sections in document order, notes are numbered here
+    for fi, filename in enumerate(filenames):
+        fragments = file_fragments[fi]
+        sections = file_sections[fi]
+        for i in range(len(fragments)):
+            result = None
+            if fragments[i] is not None:
+                result = load_fragment(ctx, fragments[i])
                 
+            if result is None:
+                if sections is None:
+                    # cached file doesn't match its references, so it's translated again
+                    sections = split_content_file(ctx, filename)
+                s = sections[i]
+                first_ref = len(ctx.note_refs)
+                process_section(ctx, s)
+                assemble_section(s)
+                result = s.sx, collect_images(s)
+                if cache is not None:
+                    fragments[i] = make_fragment(ctx, s, first_ref)
+                    cache.put(file_section_keys[fi][i], dump_entry(fragments[i]))
+                # the section tree is released when the caller is done with it
+                s = sections[i] = None
             
-            current_section.lines.append(line)
-                
-    except StopIteration:
-        pass
-    
-    return root
+            yield result
+            result = None
+        
+        if cache is not None and sections is not None:
+            cache.put(file_keys[fi], dump_entry((file_section_keys[fi], fragments)))
 
-def translate_notes(filename):
+def check_body(ctx, filenames):
     """
-    Translate notes file. Notes file consists of 1st level sections only. Each section must 
-    have an id element, all ids must be unique. Section title is ignored. 
-    @return: tuple(images, sections), sections is dict, keys are sections ids, values are section xml nodes
+    Check markup of the content files in the check mode context `ctx', errors are added 
+    to ctx.errors.
+    
+    @return: set of images names
     """
-    cf = codecs.open(filename, mode="r", encoding="utf-8")
-    f = LineStream(cf)
-    cf.close()
     images = set()
+    for filename in filenames:
+        try:
+            sections = split_content_file(ctx, filename)
+        except InvalidMarkupError, e:
+            # sections tree of the file is unknown, so the file is skipped
+            ctx.errors.append(e.message)
+            continue
+        for s in sections:
+            process_section(ctx, s)
+            collect_images(s, images)
     
-    root = split_notes_into_sections(f)
-    process_section(root)
+    return images
+
+def translate_annotation(ctx, filename, cache=None):
+    """
+    Translate annotation file. When `cache' is set, annotation of the unchanged file
+    is taken from the cache.
+    """
+    key = None
+    if cache is not None:
+        key = parsed_file_key(cache, "annotation", filename)
+        entry = cache.get(key)
+        if entry is not None:
+            result = load_fragment(ctx, cPickle.loads(entry))
+            if result is not None:
+                if ctx.stats is not None:
+                    ctx.stats.count("cached_files")
+                return result[0]
+    
+    first_ref = len(ctx.note_refs)
+    f = MappedLineStream(filename, classify_line, ctx.read_copy)
+    try:
+        ann = _translate_annotation(ctx, f)
+    except InvalidMarkupError, e:
+        raise stream_error(e, f, filename)
+    finally:
+        f.close()
     
-    sections = dict()
+    if key is not None:
+        cache.put(key, dump_entry((etree.tostring(ann, encoding="utf-8"), ctx.note_refs[first_ref:], list())))
+    return ann
+
+def _translate_annotation(ctx, f):
+    ann = ctx.element("annotation")
+    process_blocks(ctx, f, ann, ANNOTATION_BLOCKS, set())
     
-    for s in root.subsections:
-        if s.id in root.subsections:
-            raise InvalidMarkupError("Section's ids in the notes file must be unique!")
+    return ann
+
+class NotesIndex:
+    """
+    Index of the notes file sections by their ids. Section headers and ids are found with 
+    a single scan of the raw file, lines of a section are decoded only when it's loaded, 
+    so notes which are never referenced are not parsed.
+    """
+
+    def __init__(self, filename, sections=None, copy=False):
+        """
+        @param sections: sections positions returned by sections() for the same file content,
+                         the file is not scanned when they are set
+        @param copy: read the file into memory instead of mapping, see map_file()
+        """
+        self.filename = filename
+        self._map = map_file(filename, copy)
+        # note id -> tuple (start_offset, end_offset, line_number)
+        self._sections = sections
+        if sections is None:
+            self._sections = dict()
+            self._scan()
+
+    def _scan(self):
+        data = self._map
+        size = len(data)
+        line_number = 0
+        counted = 0
+        prev_id = None
+        # lines which could be section headers
+        for start in find_line_starts(data, "="):
+            line_number += data[counted:start].count("\n")
+            counted = start
+            header_end = data.find("\n", start)
+            if header_end == -1:
+                header_end = size
+            
+            header = SECTION_RE.match(self._decode(start, header_end))
+            section_level = len(header.group(1))
+            if section_level != 1:
+                raise self._error("In the notes file only first level sections allowed. Level: %s." % section_level,
+                                  line_number)
+            
+            # element "@id" must follow section header
+            id_end = data.find("\n", header_end + 1)
+            if id_end == -1:
+                id_end = size
+            id_mo = ID_RE.match(self._decode(header_end + 1, id_end))
+            if id_mo is None:
+                raise self._error("@id element is required for each section in the notes file!", line_number + 1)
+            note_id = id_mo.group(1)
+            if note_id in self._sections:
+                raise self._error("Section's ids in the notes file must be unique!", line_number + 1)
+            
+            if prev_id is not None:
+                self._close_section(prev_id, start)
+            self._sections[note_id] = (start, size, line_number)
+            prev_id = note_id
+
+    def _error(self, message, line_number):
+        return located_error(InvalidMarkupError(message), self.filename, line_number + 1)
+
+    def _decode(self, start, end):
+        return utf_8_decode(self._map[start:end], "strict", True)[0].strip(STRIP_CHARS)
+
+    def _close_section(self, note_id, end):
+        start, _, line_number = self._sections[note_id]
+        self._sections[note_id] = (start, end, line_number)
+
+    def __contains__(self, note_id):
+        return note_id in self._sections
+
+    def __len__(self):
+        return len(self._sections)
+
+    def sections(self):
+        """
+        @return: picklable positions of the sections
+        """
+        return self._sections
+
+    def position(self, note_id):
+        """
+        @return: position of the section `note_id' in the file
+        """
+        return self._sections[note_id][0]
+
+    def load(self, note_id):
+        """
+        @return: Section() object with source lines of the note `note_id'
+        """
+        start, end, line_number = self._sections[note_id]
+        lines = utf_8_decode(self._map[start:end], "strict", True)[0].split("\n")
+        if lines[-1] == "":
+            # section ends with the line break
+            lines.pop()
         
-        sections[s.id] = s
+        s = Section()
+        s.id = note_id
+        s.addr = line_number
+        s.filename = self.filename
+        s.stream = LineStream(lines)
+        s.end = len(lines)
+        return s
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+def load_note(ctx, note_id, fragment):
+    """
+    @return: Section() object of the note `note_id' made from the fragment or None if fragment 
+             doesn't match its references list
+    """
+    result = load_fragment(ctx, fragment)
+    if result is None:
+        return None
+    
+    s = Section()
+    s.id = note_id
+    s.sx, s.images = result
+    if len(s.sx) > 0 and s.sx[0].tag in ("title", fb2_tag("title")):
+        s.sx_title = s.sx[0]
+    return s
+
+def translate_notes(ctx, filename, cache=None):
+    """
+    Translate notes file. Notes file consists of 1st level sections only. Each section must 
+    have an id element, all ids must be unique. Section title is ignored. Only notes referenced 
+    from the already translated text are translated, notes referenced from them are translated 
+    next and so on. When `cache' is set, index of the unchanged file and notes translated 
+    by the previous compilations are taken from the cache.
+    @return: tuple(images, sections), sections is dict, keys are sections ids, values are section xml nodes
+    """
+    key = None
+    # note id -> fragment of the translated note
+    fragments = dict()
+    index_sections = None
+    if cache is not None:
+        key = parsed_file_key(cache, "notes", filename)
+        entry = cache.get(key)
+        if entry is not None:
+            index_sections, fragments = cPickle.loads(entry)
+            if ctx.stats is not None:
+                ctx.stats.count("cached_files")
+    changed = index_sections is None
+    
+    index = NotesIndex(filename, index_sections, ctx.read_copy)
+    try:
+        images = set()
+        sections = dict()
         
-    def _walk_images(s, im):
-        [im.add(x) for x in s.images]
+        translated_refs = 0
+        while translated_refs < len(ctx.note_refs):
+            refs = set(ctx.note_refs[translated_refs:])
+            translated_refs = len(ctx.note_refs)
+            # undefined notes are reported by the caller
+            note_ids = [note_id for note_id in refs if note_id in index and note_id not in sections]
+            # notes are translated in order of the file, so references inside them are numbered in that order
+            note_ids.sort(key=index.position)
+            for note_id in note_ids:
+                s = None
+                if note_id in fragments:
+                    s = load_note(ctx, note_id, fragments[note_id])
+                if s is None:
+                    first_ref = len(ctx.note_refs)
+                    s = index.load(note_id)
+                    process_section(ctx, s)
+                    if key is not None:
+                        fragments[note_id] = make_fragment(ctx, s, first_ref)
+                        changed = True
+                sections[note_id] = s
+                collect_images(s, images)
         
-        for subs in s.subsections:
-            _walk_images(subs, im)
+        if ctx.stats is not None:
+            ctx.stats.count("unreferenced_notes", len(index) - len(sections))
+        if key is not None and changed:
+            cache.put(key, dump_entry((index.sections(), fragments)))
+    finally:
+        index.close()
     
-    # collect images
-    _walk_images(root, images)
-
     return (images, sections)
 
 def _pp(root, level):
@@ -778,7 +1289,7 @@ def _pp(root, level):
     lines_indent = " " * (level+1)
     for x in root.subsections:
         print "%s: %s" % (indent, x)
-        for l in x.lines:
+        for l in x.lines():
             print "%s %s" % (lines_indent, l)
         _pp(x, level+1)
     
@@ -4,11 +4,10 @@ Functions for parsing project file
 
 import codecs
 import ConfigParser
+import glob
 import os.path
 from .print_ext import print_err
-
-class InvalidProjectError(BaseException):
-    pass
+from .errors import InvalidProjectError
 
 def parse_project_file(filename):
     try:
@@ -44,14 +43,16 @@ def parse_project_file(filename):
         if project_props[k] is None:
             raise InvalidProjectError("Invalid project file: required key `Project/%s' not found" % k)
         
+    project_props['content-file'] = content_files(project_props['content-file'])
+    
     # check that required files exists
-    req_files = ("content-file", "annotation-file")
-    for k in req_files:
-        if project_props[k] is None:
-            continue
-        if not os.path.isfile(project_props[k]):
+    req_files = [("content-file", x) for x in project_props['content-file']]
+    if project_props['annotation-file'] is not None:
+        req_files.append(("annotation-file", project_props['annotation-file']))
+    for k, filename in req_files:
+        if not os.path.isfile(filename):
             raise InvalidProjectError("File `%s' required for key `Project/%s' not found." %
-                                      (project_props[k], k))
+                                      (filename, k))
             
     # get book authors
     authors = list()
@@ -98,6 +99,30 @@ def parse_project_file(filename):
     return (project_props, authors, translators, doc_authors, doc_history, genres, book_sequences)
 
 
+def content_files(value):
+    """
+    Content file key is a list of file names and glob patterns, one per line, so names
+    may contain commas. Files matching a pattern are taken in order of their names.
+    
+    @return: list of content files names
+    """
+    files = list()
+    for item in value.split("\n"):
+        item = item.strip()
+        if item == "":
+            continue
+        if glob.has_magic(item):
+            matched = sorted(glob.glob(item))
+            if len(matched) == 0:
+                raise InvalidProjectError("No files match `%s' required for key `Project/content-file'." % item)
+            files.extend(matched)
+        else:
+            files.append(item)
+    
+    if len(files) == 0:
+        raise InvalidProjectError("Invalid project file: required key `Project/content-file' is empty")
+    return files
+
 def process_author_section(items):
     keys = ('first-name', 'middle-name', 'last-name', 'nickname', 'home-page', 'email')
     res = dict()
@@ -0,0 +1,176 @@
+"""
+Compilation statistics: time and memory used by the compilation stages and hot path counters
+"""
+import os
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def cpu_time():
+    """
+    @return: user and system CPU time of the current process in seconds
+    """
+    if resource is not None:
+        # more precise than os.times() which counts clock ticks
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        return r.ru_utime + r.ru_stime
+    t = os.times()
+    return t[0] + t[1]
+
+def peak_rss():
+    """
+    @return: peak resident set size of the current process in bytes or None if unknown
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss
+    # kilobytes on other systems
+    return maxrss * 1024
+
+def current_rss():
+    """
+    @return: resident set size of the current process in bytes or None if unknown
+    """
+    try:
+        f = open("/proc/self/statm")
+    except IOError:
+        return None
+    try:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    finally:
+        f.close()
+
+class Stage:
+    """
+    Context manager adding time spent inside it to the stage totals.
+    """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        if self.stats.memory:
+            self.peak_rss = peak_rss()
+        self.wall = time.time()
+        self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_time(self.name, time.time() - self.wall, cpu_time() - self.cpu)
+        if self.stats.memory:
+            self.stats.add_memory(self.name, self.peak_rss)
+        return False
+
+class NullStage:
+    """
+    Context manager used when statistics are not collected.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_STAGE = NullStage()
+
+def stage(stats, name):
+    """
+    @return: context manager measuring stage `name' or doing nothing when `stats' is None
+    """
+    if stats is None:
+        return NULL_STAGE
+    return Stage(stats, name)
+
+class CompileStats:
+    """
+    Wall and CPU time of the compilation stages and values of the counters. Stage entered
+    several times is reported once with the total time. Counters are updated only where
+    CompileContext.stats is set, so disabled statistics cost a single attribute check.
+    
+    When `memory' is set, process memory usage is recorded at the end of each stage: peak RSS
+    from getrusage(), its growth during the stage and current RSS from /proc when it's 
+    available. Python allocations are not traced, tracemalloc doesn't exist on Python 2.
+    """
+
+    def __init__(self, memory=False):
+        # stage names in order of the first completion
+        self.stages = list()
+        # stage name -> [wall_time, cpu_time]
+        self.times = dict()
+        # counter name -> value
+        self.counters = dict()
+        self.memory = memory
+        # stage name -> dict of memory usage values in bytes, maximum of all stage entrances
+        self.memory_usage = dict()
+
+    def add_time(self, name, wall, cpu):
+        if name not in self.times:
+            self.stages.append(name)
+            self.times[name] = [0.0, 0.0]
+        t = self.times[name]
+        t[0] += wall
+        t[1] += cpu
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_memory(self, name, start_peak_rss):
+        """
+        Record memory usage at the end of stage `name', `start_peak_rss' is process peak RSS
+        at the stage start.
+        """
+        usage = {'peak_rss': peak_rss(), 'rss': current_rss()}
+        if usage['peak_rss'] is not None and start_peak_rss is not None:
+            usage['peak_rss_growth'] = usage['peak_rss'] - start_peak_rss
+        
+        prev = self.memory_usage.get(name, dict())
+        for k, v in prev.iteritems():
+            if usage.get(k) is None or (v is not None and v > usage[k]):
+                usage[k] = v
+        self.memory_usage[name] = usage
+
+    def as_dict(self):
+        """
+        @return: statistics as a JSON serializable dict
+        """
+        stages = list()
+        for name in self.stages:
+            item = {'name': name, 'wall': self.times[name][0], 'cpu': self.times[name][1]}
+            if name in self.memory_usage:
+                item['memory'] = self.memory_usage[name]
+            stages.append(item)
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def format(self):
+        """
+        @return: statistics as a human readable table
+        """
+        lines = ["%-16s %10s %10s" % ("stage", "wall, ms", "cpu, ms")]
+        for name in self.stages:
+            wall, cpu = self.times[name]
+            lines.append("%-16s %10.1f %10.1f" % (name, wall * 1000, cpu * 1000))
+        for name in sorted(self.counters.keys()):
+            lines.append("%-16s %21d" % (name, self.counters[name]))
+        return "\n".join(lines)
+
+    def format_memory(self):
+        """
+        @return: memory usage as a human readable table
+        """
+        def mb(usage, key):
+            v = usage.get(key)
+            if v is None:
+                return "-"
+            return "%.1f" % (v / 1048576.0)
+        
+        lines = ["%-16s %10s %10s %10s" % ("stage", "peak, MB", "growth, MB", "rss, MB")]
+        for name in self.stages:
+            usage = self.memory_usage.get(name, dict())
+            lines.append("%-16s %10s %10s %10s" % (name, mb(usage, 'peak_rss'), mb(usage, 'peak_rss_growth'),
+                                                   mb(usage, 'rss')))
+        return "\n".join(lines)
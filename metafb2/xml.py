@@ -7,7 +7,6 @@ import codecs
 
 FB2_NAMESPACE = "http://www.gribuser.ru/xml/fictionbook/2.0"
 XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
-TEXT_XML_TEMPLATE = '<%%(tag)s xmlns="%s" xmlns:l="%s">%%(text)s</%%(tag)s>' % (FB2_NAMESPACE, XLINK_NAMESPACE)
 
 NSMAP = {None : FB2_NAMESPACE, 'l': XLINK_NAMESPACE}
 
@@ -0,0 +1,86 @@
+"""
+Streaming writer of single entry zip archives
+"""
+import struct
+import time
+import zlib
+
+# general purpose flags: sizes and crc are written after the data, name is utf-8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+METHOD_DEFLATED = 8
+VERSION = 20
+# unix, regular file with rw-r--r-- mode
+CREATE_SYSTEM = 3
+EXTERNAL_ATTR = (0100644 << 16)
+MAX_SIZE = 0xffffffff
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+DATA_DESCRIPTOR = struct.Struct("<4s3L")
+CENTRAL_HEADER = struct.Struct("<4s2B5H3L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+
+def dos_time(t):
+    """
+    @return: tuple (dos_time, dos_date) of the local time `t'
+    """
+    lt = time.localtime(t)
+    return ((lt.tm_hour << 11) | (lt.tm_min << 5) | (lt.tm_sec // 2),
+            ((lt.tm_year - 1980) << 9) | (lt.tm_mon << 5) | lt.tm_mday)
+
+class ZipEntryWriter:
+    """
+    File-like object writing zip archive with the single deflated entry into file `f'.
+    Data is compressed as it's written, entry sizes and crc are written after the data
+    in the data descriptor, so the whole entry is never kept in memory and file `f'
+    doesn't need to be seekable. Archive is complete after close(), `f' is not closed.
+    """
+
+    def __init__(self, f, name, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.__f = f
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        self.__name = name
+        self.__flags = FLAG_DATA_DESCRIPTOR
+        try:
+            name.decode("ascii")
+        except UnicodeDecodeError:
+            self.__flags |= FLAG_UTF8
+        self.__time, self.__date = dos_time(time.time())
+        self.__compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.__crc = 0
+        self.__size = 0
+        self.__compressed_size = 0
+        self.__offset = 0
+
+        self.__write_raw(LOCAL_HEADER.pack("PK\x03\x04", VERSION, self.__flags, METHOD_DEFLATED,
+                                           self.__time, self.__date, 0, 0, 0, len(name), 0))
+        self.__write_raw(name)
+        self.__data_offset = self.__offset
+
+    def __write_raw(self, data):
+        self.__f.write(data)
+        self.__offset += len(data)
+
+    def write(self, data):
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__size += len(data)
+        self.__write_raw(self.__compressor.compress(data))
+
+    def close(self):
+        self.__write_raw(self.__compressor.flush())
+        self.__compressed_size = self.__offset - self.__data_offset
+        if self.__size > MAX_SIZE or self.__compressed_size > MAX_SIZE:
+            raise IOError("Zip entry `%s' is too large" % self.__name)
+        crc = self.__crc & 0xffffffff
+
+        self.__write_raw(DATA_DESCRIPTOR.pack("PK\x07\x08", crc, self.__compressed_size, self.__size))
+
+        central_offset = self.__offset
+        self.__write_raw(CENTRAL_HEADER.pack("PK\x01\x02", VERSION, CREATE_SYSTEM, VERSION, self.__flags,
+                                             METHOD_DEFLATED, self.__time, self.__date, crc,
+                                             self.__compressed_size, self.__size, len(self.__name),
+                                             0, 0, 0, 0, EXTERNAL_ATTR, 0))
+        self.__write_raw(self.__name)
+        central_size = self.__offset - central_offset
+        self.__write_raw(END_RECORD.pack("PK\x05\x06", 0, 0, 1, 1, central_size, central_offset, 0))
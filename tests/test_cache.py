@@ -0,0 +1,92 @@
+"""
+Tests of the translated sections cache used by incremental compilation.
+"""
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from metafb2 import cache
+from metafb2 import cmd_watch
+from metafb2 import images
+from metafb2 import markup
+
+PROJECT = """[Project]
+content-file = content.txt
+annotation-file = annotation.txt
+book-title = Title
+genres = sf
+lang = en
+book-id = 1
+
+[Author/1]
+first-name = A
+last-name = B
+"""
+
+SECTIONS = 10
+
+class WatchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # project paths are relative to the current directory
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.write("project.mfb2", PROJECT)
+        self.write("annotation.txt", "Annotation\n")
+        self.write_content(dict())
+        self.translated = 0
+        process_section = markup.process_section
+        def counting_process_section(ctx, section):
+            if section.parent is not None and section.parent.parent is None:
+                # top level section
+                self.translated += 1
+            process_section(ctx, section)
+        self.process_section = process_section
+        markup.process_section = counting_process_section
+
+    def tearDown(self):
+        markup.process_section = self.process_section
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def write(self, filename, text):
+        f = open(os.path.join(self.dir, filename), "wb")
+        try:
+            f.write(text)
+        finally:
+            f.close()
+
+    def write_content(self, changed):
+        """
+        Write content file, `changed' is dict section number -> text of its paragraph
+        """
+        lines = list()
+        for n in range(SECTIONS):
+            lines.append("= Section %d" % n)
+            lines.append("")
+            lines.append(changed.get(n, "Text of section %d." % n))
+            lines.append("")
+        self.write("content.txt", "\n".join(lines))
+
+    def build(self):
+        self.translated = 0
+        cmd_watch.build("project.mfb2", "result.fb2", images.PictureEncoder(), self.section_cache)
+        return self.translated
+
+    def test_sections_kept_after_unchanged_file(self):
+        self.section_cache = cache.MemoryCache()
+        self.assertEqual(self.build(), SECTIONS)
+        # rebuild after a change of another file, content file is taken from the cache
+        self.write("annotation.txt", "Changed annotation\n")
+        self.assertEqual(self.build(), 0)
+        # only the changed section is translated again
+        self.write_content({3: "Changed text."})
+        self.assertEqual(self.build(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests of the pictures optimization.
+"""
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from metafb2 import images
+from metafb2.images import Image
+
+@unittest.skipIf(Image is None, "Pillow is not available")
+class PictureOptimizerTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".jpg")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def save_jpeg(self, orientation):
+        # left half is red, right half is blue
+        im = Image.new("RGB", (80, 40), (255, 0, 0))
+        im.paste((0, 0, 255), (40, 0, 80, 40))
+        exif = Image.Exif()
+        exif[images.ORIENTATION_TAG] = orientation
+        im.save(self.filename, "JPEG", quality=95, exif=exif.tobytes())
+
+    def optimize(self, **params):
+        return Image.open(StringIO(images.PictureOptimizer(**params).optimize(self.filename)))
+
+    def assertColor(self, im, xy, color):
+        for actual, expected in zip(im.getpixel(xy), color):
+            self.assertTrue(abs(actual - expected) < 40, "%r != %r" % (im.getpixel(xy), color))
+
+    def test_orientation_applied(self):
+        # orientation 6: the picture is displayed rotated 90 degrees clockwise
+        self.save_jpeg(6)
+        im = self.optimize(max_size=60)
+        self.assertEqual(im.size, (30, 60))
+        self.assertColor(im, (15, 10), (255, 0, 0))
+        self.assertColor(im, (15, 50), (0, 0, 255))
+        exif = im._getexif() or dict()
+        self.assertTrue(exif.get(images.ORIENTATION_TAG, 1) == 1)
+
+    def test_jobs_default_to_cpu_count(self):
+        self.assertEqual(images.PictureOptimizer().jobs, images.cpu_count())
+        self.assertEqual(images.PictureOptimizer(jobs=2).jobs, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Regression tests of the inline markup translation.
+"""
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lxml import etree
+from metafb2 import markup
+from metafb2.linestream import LineStream
+from metafb2.linestream import MappedLineStream
+from metafb2.errors import InvalidMarkupError
+
+class PprocessTest(unittest.TestCase):
+
+    def pprocess(self, text):
+        return etree.tostring(markup.pprocess(markup.CompileContext(), "p", text), encoding=unicode)
+
+    def test_inline_tags(self):
+        p = self.pprocess(u"H<sub>2</sub>O and **x<sup>2</sup>**")
+        self.assertTrue(u"<sub>2</sub>O and <strong>x<sup>2</sup></strong>" in p)
+
+    def test_stray_closing_tag(self):
+        # stray tag is an error whether or not the paragraph has other markup
+        for text in (u"x </sup> y", u"**a** </sup> y", u"x </sub> y"):
+            self.assertRaises(InvalidMarkupError, self.pprocess, text)
+
+    def test_stray_closing_tag_check_mode(self):
+        ctx = markup.CompileContext(check=True)
+        self.assertRaises(InvalidMarkupError, markup.pprocess, ctx, "p", u"x </sup> y")
+
+    def test_check_mode_note_refs(self):
+        # check mode registers the same references as the compilation
+        for text in (u"a{{n1}} b{{n2}}", u"**a{{n1}}** //b{{n2}}//", u"{{n*1}} **b** {{n2}}"):
+            ctx = markup.CompileContext()
+            markup.pprocess(ctx, "p", text)
+            check_ctx = markup.CompileContext(check=True)
+            markup.pprocess(check_ctx, "p", text)
+            self.assertEqual(check_ctx.note_refs, ctx.note_refs)
+
+    def test_check_mode_nesting(self):
+        ctx = markup.CompileContext(check=True)
+        for text in (u"**a //b** c//", u"<sup>a **b</sup>**", u"<sub>a"):
+            self.assertRaises(InvalidMarkupError, self.pprocess, text)
+            self.assertRaises(InvalidMarkupError, markup.pprocess, ctx, "p", text)
+
+class CheckSectionTest(unittest.TestCase):
+
+    def check(self, lines):
+        ctx = markup.CompileContext(check=True)
+        section = markup.split_into_sections(LineStream(lines), "c.txt").subsections[0]
+        markup.process_section(ctx, section)
+        return ctx.errors, section.images
+
+    def test_errors_after_block_error(self):
+        errors, images = self.check([u"= Title", u"", u"**a //b** c//", u"", u"@img:missing.png",
+                                     u"", u"@s:", u"", u"text"])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith(u"File `c.txt', line 3: Improperly nested"))
+        self.assertEqual(errors[1], u"File `c.txt', line 7: Missing subtitle text")
+        # picture after the broken paragraph is still checked
+        self.assertEqual(images, set([u"missing.png"]))
+
+    def test_errors_after_container_block_error(self):
+        errors, images = self.check([u"= Title", u"@cite", u"<sub>a", u"@s:x", u"@cite/", 
+                                     u"@poem", u"v", u"@poem/ **x//y**//", u"@img:"])
+        self.assertEqual([e.split(":")[0] for e in errors], 
+                         [u"File `c.txt', line 3", u"File `c.txt', line 8", u"File `c.txt', line 9"])
+
+class SplitSectionsTest(unittest.TestCase):
+
+    def tree(self, sections):
+        return [(s.begin, s.end, self.tree(s.subsections)) for s in sections]
+
+    def test_mapped_file(self):
+        # headers are found in the raw file, the sections must be the same as from the decoded lines
+        text = u"= A\n == \u0411\n\ntext\n\t== C\n== D\n\n= E\ntext".encode("utf-8")
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, text)
+            os.close(fd)
+            f = MappedLineStream(filename)
+            mapped = self.tree(markup.split_into_sections(f, filename).subsections)
+            f.close()
+        finally:
+            os.remove(filename)
+        lines = LineStream(text.decode("utf-8").split("\n"))
+        self.assertEqual(mapped, self.tree(markup.split_into_sections(lines).subsections))
+        self.assertEqual(mapped, [(0, 1, [(1, 4, []), (4, 7, [])]), (7, 9, [])])
+
+if __name__ == "__main__":
+    unittest.main()